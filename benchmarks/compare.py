@@ -0,0 +1,55 @@
+'''Compare two result files of benchmarks.service.
+
+Prints the change of throughput and latency percentiles of every method
+and of the peak RSS and the disk size, and marks regressions larger than
+a threshold. Exits with status 1 if there are regressions. Run from the
+project root:
+
+    python -m benchmarks.compare old.json new.json
+'''
+import argparse
+import json
+import sys
+
+# metrics of methods and whether their bigger values are better
+METRICS = {'ops_per_s': True, 'p50_us': False, 'p95_us': False, 'p99_us': False}
+
+
+def change(old: float, new: float) -> float:
+    '''Get a relative change of a value in percent.'''
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('old', help='results of the baseline run')
+    parser.add_argument('new', help='results of the compared run')
+    parser.add_argument('--threshold', type=float, default=10.0, help='regression threshold in percent')
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old['config'] != new['config']:
+        print(f"warning: runs have different configs: {old['config']} != {new['config']}")
+
+    rows: list[tuple[str, float, float, bool]] = []
+    for method in sorted(set(old['methods']) & set(new['methods'])):
+        for metric, higher_is_better in METRICS.items():
+            rows.append((f"{method}.{metric}", old['methods'][method][metric], new['methods'][method][metric],
+                         higher_is_better))
+    rows.append(('peak_rss_mib', old['peak_rss_mib'], new['peak_rss_mib'], False))
+    rows.append(('disk_total_bytes', old['disk_total_bytes'], new['disk_total_bytes'], False))
+
+    regressions = 0
+    for name, old_value, new_value, higher_is_better in rows:
+        delta = change(old_value, new_value)
+        regressed = (-delta if higher_is_better else delta) > args.threshold
+        regressions += regressed
+        print(f"{name:32} {old_value:14,.1f} {new_value:14,.1f} {delta:+8.1f}%{'  REGRESSION' if regressed else ''}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
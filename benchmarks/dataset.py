@@ -0,0 +1,57 @@
+'''Deterministic generator of synthetic models, cars and sales.
+
+The same sizes and seed always give the same rows, so benchmark runs are
+comparable. Rows are generated lazily, datasets of millions of cars don't
+have to fit in memory.
+'''
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Iterator
+
+from models import Car, CarStatus, Model, Sale
+
+BRANDS = ["Kia", "Mazda", "Nissan", "Renault", "Toyota", "Skoda", "Hyundai", "Lada"]
+# characters allowed in vin numbers
+VIN_ALPHABET = "ABCDEFGHJKLMNPRSTUVWXYZ0123456789"
+
+
+def make_vin(i: int) -> str:
+    '''Make a unique vin number of the i-th car.'''
+    prefix = ''.join(random.Random(i).choices(VIN_ALPHABET, k=8))
+    return f"{prefix}{i:09d}"
+
+
+def make_models(count: int, seed: int = 0) -> Iterator[Model]:
+    '''Generate models with ids from 1 to `count`.'''
+    rng = random.Random(seed)
+    for model_id in range(1, count + 1):
+        yield Model(id=model_id, name=f"Model-{model_id}", brand=rng.choice(BRANDS))
+
+
+def make_cars(count: int, model_count: int, seed: int = 0) -> Iterator[Car]:
+    '''Generate cars of random models, most of them are available.'''
+    rng = random.Random(seed)
+    statuses = [CarStatus.available] * 7 + [CarStatus.reserve, CarStatus.delivery]
+    for i in range(count):
+        yield Car(
+            vin=make_vin(i),
+            model=rng.randint(1, model_count),
+            price=Decimal(rng.randint(500_000, 5_000_000)) / 100,
+            date_start=datetime(2024, 1, 1) + timedelta(minutes=rng.randrange(500_000)),
+            status=rng.choice(statuses),
+        )
+
+
+def make_sales(car_count: int, sale_count: int, seed: int = 0) -> Iterator[Sale]:
+    '''Generate sales of `sale_count` different cars out of the first `car_count` ones.'''
+    rng = random.Random(seed)
+    for i in rng.sample(range(car_count), sale_count):
+        vin = make_vin(i)
+        sales_date = datetime(2024, 6, 1) + timedelta(days=rng.randrange(365))
+        yield Sale(
+            sales_number=f"{sales_date:%Y%m%d}#{vin}",
+            car_vin=vin,
+            sales_date=sales_date,
+            cost=Decimal(rng.randint(500_000, 5_000_000)) / 100,
+        )
@@ -0,0 +1,61 @@
+'''Microbenchmark of decoding records of the cars table.
+
+Compares the validating Car.make_object with the trusted decode paths of
+the text and the binary formats. Run from the project root:
+
+    PYTHONPATH=src python -m benchmarks.decode
+'''
+import argparse
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from models import Car, CarStatus
+from storage import BinaryFormat, TextFormat
+
+
+def make_cars(count: int) -> list[Car]:
+    '''Make cars with different field values.'''
+    statuses = list(CarStatus)
+    return [
+        Car(
+            vin=f"BENCH{i:012d}",
+            model=i % 100,
+            price=Decimal(10000 + i % 5000) / 100,
+            date_start=datetime(2024, 1, 1) + timedelta(minutes=i),
+            status=statuses[i % len(statuses)],
+        )
+        for i in range(count)
+    ]
+
+
+def rows_per_second(decode, records: list) -> float:
+    '''Measure how many records a decode function handles per second.'''
+    start = time.perf_counter()
+    for record in records:
+        decode(record)
+    return len(records) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000, help='number of decoded records')
+    args = parser.parse_args()
+
+    cars = make_cars(args.rows)
+    text_format = TextFormat(Car)
+    binary_format = BinaryFormat(Car)
+    text_records = [text_format.encode(car) for car in cars]
+    binary_records = [binary_format.encode(car) for car in cars]
+
+    results = {
+        'text, validated (Car.make_object)': rows_per_second(lambda r: Car.make_object(r.decode()), text_records),
+        'text, trusted (TextFormat.decode)': rows_per_second(text_format.decode, text_records),
+        'binary, trusted (BinaryFormat.decode)': rows_per_second(binary_format.decode, binary_records),
+    }
+    for name, speed in results.items():
+        print(f"{name:40} {speed:12,.0f} rows/s")
+
+
+if __name__ == '__main__':
+    main()
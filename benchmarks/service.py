@@ -0,0 +1,133 @@
+'''Benchmark of the task methods of CarService on a synthetic dataset.
+
+Every method is called many times on a fresh database and its throughput
+and latency percentiles are measured. Peak RSS of the process and sizes
+of the database files are recorded too. Results are written as JSON, two
+result files are compared with `python -m benchmarks.compare`. Run from
+the project root:
+
+    PYTHONPATH=src python -m benchmarks.service --cars 100000 --output results.json
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+from typing import Any, Callable, Iterable
+
+from benchmarks.dataset import make_cars, make_models, make_sales, make_vin
+from bibip_car_service import CarService
+from models import CarStatus
+
+
+def percentile(latencies: list[int], p: float) -> float:
+    '''Get a percentile of sorted latencies in nanoseconds as microseconds.'''
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] / 1000
+
+
+def measure(method: Callable, calls: Iterable[tuple]) -> dict[str, float]:
+    '''Call a method with every tuple of arguments and measure the calls.'''
+    latencies: list[int] = []
+    for args in calls:
+        start = time.perf_counter_ns()
+        method(*args)
+        latencies.append(time.perf_counter_ns() - start)
+    latencies.sort()
+    total = sum(latencies) / 1e9
+    return {
+        'calls': len(latencies),
+        'total_s': round(total, 6),
+        'ops_per_s': round(len(latencies) / total, 1) if total else 0.0,
+        'p50_us': percentile(latencies, 50),
+        'p95_us': percentile(latencies, 95),
+        'p99_us': percentile(latencies, 99),
+        'max_us': latencies[-1] / 1000,
+    }
+
+
+def disk_usage(directory: str) -> dict[str, int]:
+    '''Get sizes of the files of a database directory in bytes.'''
+    return {name: os.path.getsize(os.path.join(directory, name)) for name in sorted(os.listdir(directory))}
+
+
+def run(args: argparse.Namespace, directory: str) -> dict[str, Any]:
+    '''Run the benchmark in an empty directory.'''
+    rng = random.Random(args.seed)
+    sale_count = min(args.sales, args.cars)
+    lookup_vins = [make_vin(rng.randrange(args.cars)) for _ in range(args.lookups)]
+    methods: dict[str, dict[str, float]] = {}
+
+    service = CarService(directory, storage_format=args.format, index_backend=args.index)
+    methods['add_model'] = measure(service.add_model, ((model,) for model in make_models(args.models, args.seed)))
+    methods['add_car'] = measure(service.add_car, ((car,) for car in make_cars(args.cars, args.models, args.seed)))
+    sales = list(make_sales(args.cars, sale_count, args.seed))
+    methods['sell_car'] = measure(service.sell_car, ((sale,) for sale in sales))
+    methods['get_cars'] = measure(service.get_cars, [(CarStatus.available,)] * args.repeats)
+    methods['get_cars_page'] = measure(service.get_cars, [(CarStatus.available, 100)] * args.lookups)
+    methods['get_car_info'] = measure(service.get_car_info, ((vin,) for vin in lookup_vins))
+    methods['top_models_by_sales'] = measure(service.top_models_by_sales, [()] * args.lookups)
+
+    updated = rng.sample(range(args.cars), min(args.updates, args.cars))
+    methods['update_vin'] = measure(service.update_vin, ((make_vin(i), make_vin(args.cars + i)) for i in updated))
+    reverted = rng.sample(sales, min(args.updates, sale_count))
+    # sales of the updated cars were moved to their new vins
+    new_vins = {make_vin(i): make_vin(args.cars + i) for i in updated}
+    methods['revert_sale'] = measure(service.revert_sale, (
+        (sale.sales_number.replace(sale.car_vin, new_vins.get(sale.car_vin, sale.car_vin)),) for sale in reverted))
+    service.close()
+
+    files = disk_usage(directory)
+    return {
+        'config': {
+            'models': args.models, 'cars': args.cars, 'sales': sale_count, 'lookups': args.lookups,
+            'updates': args.updates, 'repeats': args.repeats, 'format': args.format, 'index': args.index,
+            'seed': args.seed,
+        },
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'methods': methods,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'disk_bytes': files,
+        'disk_total_bytes': sum(files.values()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models', type=int, default=1000, help='number of models')
+    parser.add_argument('--cars', type=int, default=10_000, help='number of cars, e.g. 10000, 100000 or 1000000')
+    parser.add_argument('--sales', type=int, default=5000, help='number of sold cars')
+    parser.add_argument('--lookups', type=int, default=10_000, help='number of calls of the read methods')
+    parser.add_argument('--updates', type=int, default=1000, help='number of calls of update_vin and revert_sale')
+    parser.add_argument('--repeats', type=int, default=5, help='number of full get_cars calls')
+    parser.add_argument('--format', choices=['text', 'binary'], default='text', help='storage format')
+    parser.add_argument('--index', choices=['memory', 'compact', 'btree'], default='memory', help='primary index backend')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the dataset generator')
+    parser.add_argument('--dir', help='database directory, a temporary one is used by default')
+    parser.add_argument('--output', help='JSON file for the results, they are printed by default')
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix='bibip-bench-')
+    os.makedirs(directory, exist_ok=True)
+    if os.listdir(directory):
+        parser.error(f"Database directory isn't empty: {directory}")
+    try:
+        results = run(args, directory)
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from functools import partial
+from typing import Any, Callable, Iterable
+
+from bibip_car_service import CarService
+from models import Car, CarFullInfo, CarStatus, Model, ModelSaleStats, Sale
+
+
+class AsyncCarService:
+    '''An asyncio facade of `CarService`.\n
+    Calls of the service are run in a thread pool of `max_workers` threads,
+    so that its file I/O doesn't block the event loop. Calls of `get_car_info`
+    made in the same iteration of the loop are coalesced into one batch that
+    is looked up by one call of `CarService.get_car_info_many`.'''
+
+    def __init__(self, service: CarService, max_workers: int = 4) -> None:
+        self.service = service
+        self.__executor = ThreadPoolExecutor(max_workers, thread_name_prefix='car-service')
+        # vin -> futures of the get_car_info calls waiting for the next batch
+        self.__info_requests: dict[str, list[asyncio.Future]] | None = None
+
+    async def __run(self, method: Callable, *args, **kwargs) -> Any:
+        '''Run a method of the service in the thread pool.'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, partial(method, *args, **kwargs))
+
+    async def __aenter__(self) -> 'AsyncCarService':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        '''Close the service and shut the thread pool down.'''
+        await self.__run(self.service.close)
+        self.__executor.shutdown()
+
+    async def add_model(self, model: Model) -> Model:
+        return await self.__run(self.service.add_model, model)
+
+    async def add_car(self, car: Car) -> Car:
+        return await self.__run(self.service.add_car, car)
+
+    async def add_models(self, models: Iterable[Model]) -> int:
+        return await self.__run(self.service.add_models, models)
+
+    async def add_cars(self, cars: Iterable[Car]) -> int:
+        return await self.__run(self.service.add_cars, cars)
+
+    async def sell_car(self, sale: Sale) -> Car | None:
+        return await self.__run(self.service.sell_car, sale)
+
+    async def sell_cars(self, sales: Iterable[Sale]) -> int:
+        return await self.__run(self.service.sell_cars, sales)
+
+    async def load_file(self, file_path: str, table_name: str) -> int:
+        return await self.__run(self.service.load_file, file_path, table_name)
+
+    async def query(self, table_name: str, where: dict[str, Any] | None = None,
+                    fields: list[str] | None = None) -> list[Model | Car | Sale | dict[str, Any]]:
+        '''Find records of a table that match all conditions (see `CarService.query`).\n
+        Returns: a list of all found records.'''
+        return await self.__run(lambda: list(self.service.query(table_name, where, fields)))
+
+    async def get_cars(self, status: CarStatus, limit: int | None = None, after: str | None = None) -> list[Car]:
+        return await self.__run(self.service.get_cars, status, limit, after)
+
+    async def get_car_info(self, vin: str) -> CarFullInfo | None:
+        '''Get detailed information about a car by vin.\n
+        The call joins a batch of calls made in the same iteration of the event loop.'''
+        loop = asyncio.get_running_loop()
+        if self.__info_requests is None:
+            self.__info_requests = {}
+            loop.call_soon(self.__look_up_infos)
+        future = loop.create_future()
+        self.__info_requests.setdefault(vin, []).append(future)
+        return await future
+
+    async def get_car_info_many(self, vins: Iterable[str]) -> list[CarFullInfo | None]:
+        return await self.__run(self.service.get_car_info_many, list(vins))
+
+    def __look_up_infos(self) -> None:
+        '''Look up a batch of get_car_info calls with one call of the service.'''
+        requests, self.__info_requests = self.__info_requests, None
+        vins = list(requests)
+        job = asyncio.get_running_loop().run_in_executor(self.__executor, self.service.get_car_info_many, vins)
+
+        def resolve(job: asyncio.Future) -> None:
+            error = job.exception()
+            infos = [None] * len(vins) if error else job.result()
+            for vin, info in zip(vins, infos):
+                for future in requests[vin]:
+                    if future.done():  # if the call was cancelled
+                        continue
+                    if error:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(info)
+
+        job.add_done_callback(resolve)
+
+    async def get_sales(self, start: datetime, end: datetime) -> list[Sale]:
+        return await self.__run(self.service.get_sales, start, end)
+
+    async def revenue(self, start: datetime, end: datetime) -> Decimal:
+        return await self.__run(self.service.revenue, start, end)
+
+    async def aggregate(self, group_by: list[str],
+                        metrics: dict[str, tuple[str, str | Callable[[dict[str, Any]], Any] | None]],
+                        table: str = 'sales') -> list[dict[str, Any]]:
+        return await self.__run(self.service.aggregate, group_by, metrics, table)
+
+    async def update_vin(self, vin: str, new_vin: str) -> Car | None:
+        return await self.__run(self.service.update_vin, vin, new_vin)
+
+    async def revert_sale(self, sales_number: str) -> Car | None:
+        return await self.__run(self.service.revert_sale, sales_number)
+
+    async def compact_sales(self) -> None:
+        await self.__run(self.service.compact_sales)
+
+    async def top_models_by_sales(self, k: int = 3) -> list[ModelSaleStats]:
+        return await self.__run(self.service.top_models_by_sales, k)
+
+    async def checkpoint(self) -> None:
+        await self.__run(self.service.checkpoint)
+
+    async def sync(self) -> None:
+        await self.__run(self.service.sync)
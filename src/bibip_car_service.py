@@ -1,268 +1,1235 @@
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import Decimal
+import heapq
+from itertools import islice
 import os
+import threading
+import time
+from typing import Any, BinaryIO, Callable, Iterable, Iterator
 
-from sortedcontainers import SortedDict
-from models import Car, CarFullInfo, CarStatus, Model, ModelSaleStats, Sale, DatabaseRecord as db
+from sortedcontainers import SortedList, SortedSet
+
+from btree_index import BTreeIndex
+from cache import LRUCache
+from cdc import ChangeLog
+from columnar import Snapshot
+from compact_index import CompactIndex
+from loader import read_objects
+from locks import ReadWriteLock
+from metrics import Metrics
+from models import Car, CarFullInfo, CarStatus, Model, ModelSaleStats, Sale, construct_trusted
+from parallel import RecordFilter, ScanPool
+from storage import make_formats, read_records, read_settings, write_settings
+from table_index import TableIndex
+from wal import WriteAheadLog
 
 
 class CarService:
+    # sales table is compacted when it has at least this many removed sales
+    # and not less than the number of remaining ones
+    min_compaction_size = 1000
+    # write-ahead log is checkpointed when it has this many entries
+    wal_checkpoint_size = 10000
+    # bulk methods write and log objects in chunks of this size
+    bulk_chunk_size = 10000
+    # full scans of tables with at least this many records are split between processes
+    parallel_scan_size = 100_000
+    # methods whose calls are timed when metrics are on
+    timed_methods = ('add_model', 'add_car', 'add_models', 'add_cars', 'sell_car', 'sell_cars', 'load_file',
+                     'get_cars', 'get_car_info', 'get_car_info_many', 'get_sales', 'revenue', 'update_vin',
+                     'revert_sale', 'compact_sales', 'top_models_by_sales', 'aggregate', 'checkpoint', 'sync')
+
+    def __table(self, file_name: str) -> BinaryIO:
+        '''Get a long-lived handle of a table file, opening it on first use.\n
+        Readers can ask for a handle at once, so it's opened holding a lock.'''
+        f = self.__files.get(file_name)
+        if f is None:
+            with self.__files_lock:
+                f = self.__files.get(file_name)
+                if f is None:
+                    f = self.__files[file_name] = open(self.root_directory_path + "/" + file_name, "r+b")
+                    if self.__metrics:
+                        self.__metrics.count('file_opens')
+        return f
+
+    def __read_record(self, file_name: str, line_number: int) -> bytes:
+        '''Read a record of a table by its line number.\n
+        The record is read at its offset without moving the handle,
+        so that many threads can read at once.'''
+        record_size = self.__formats[file_name].record_size
+        if self.__metrics:
+            self.__count_io('bytes_read', record_size)
+        return os.pread(self.__table(file_name).fileno(), record_size, line_number * record_size)
+
+    def __write_record(self, file_name: str, line_number: int, record: bytes) -> None:
+        '''Overwrite a record of a table by its line number.'''
+        f = self.__table(file_name)
+        f.seek(line_number * self.__formats[file_name].record_size)
+        f.write(record)
+        if self.__snapshot is not None:
+            self.__changed_lines.setdefault(file_name, set()).add(line_number)
+        f.flush()
+        if self.__metrics:
+            self.__count_io('bytes_written', len(record))
+
+    def __encode(self, file_name: str, obj: Model | Car | Sale) -> bytes:
+        '''Make a record of a table from an object.'''
+        return self.__formats[file_name].encode(obj)
+
+    def __decode(self, file_name: str, record: bytes) -> Any:
+        '''Make an object from a record of a table.'''
+        return self.__formats[file_name].decode(record)
+
+    def __scan_records(self, file_name: str) -> Iterator[tuple[int, bytes]]:
+        '''Read all records of a table sequentially with their line numbers.'''
+        records = enumerate(read_records(self.root_directory_path + "/" + file_name,
+                                         self.__formats[file_name].record_size))
+        return self.__count_scan(file_name, records) if self.__metrics else records
 
-    def __find_record_of_obj(self, ind: str | int, file_name: str, dict: SortedDict) -> tuple[str, int] | None:
-        line_number = dict[ind] if ind in dict else None
+    def __count_scan(self, file_name: str, records: Iterator[tuple[int, bytes]]) -> Iterator[tuple[int, bytes]]:
+        '''Count the opened file and the bytes read by a scan of a table.'''
+        self.__metrics.count('file_opens')
+        scanned = 0
+        try:
+            for line_number, record in records:
+                scanned += 1
+                yield line_number, record
+        finally:
+            self.__metrics.count('bytes_read', scanned * self.__formats[file_name].record_size)
 
-        if line_number is not None:
-            with open(self.root_directory_path + "/" + file_name, "r") as f:
-                f.seek(line_number * (self.__record_len + self.__ws_size))
-                val = f.read(self.__record_len)
-                return val, line_number
-        return None
+    def __count_io(self, counter: str, size: int) -> None:
+        '''Count a random access to a record of a table.'''
+        self.__metrics.count('seeks')
+        self.__metrics.count(counter, size)
+
+    def __scan_fields(self, file_name: str) -> Iterator[tuple[int, list[Any] | None]]:
+        '''Read raw fields of all records of a table sequentially with their line numbers.\n
+        Fields of removed records are None.'''
+        split = self.__formats[file_name].split
+        for line_number, record in self.__scan_records(file_name):
+            yield line_number, split(record)
+
+    def __append_record(self, file_name: str, record: bytes) -> None:
+        '''Append a record to the end of a table.'''
+        f = self.__table(file_name)
+        f.seek(0, os.SEEK_END)
+        f.write(record)
+        f.flush()
+        if self.__metrics:
+            self.__count_io('bytes_written', len(record))
+
+    @staticmethod
+    def __copy(obj: Model | Car | Sale) -> Any:
+        '''Make a shallow copy of an object, so that a cached object is never changed by a caller.'''
+        return construct_trusted(type(obj), **obj.__dict__)
+
+    def __find_obj(self, key: str | int, file_name: str, index: TableIndex | BTreeIndex) -> tuple[Any, int] | None:
+        '''Find an object by its primary key in the cache or in a table.\n
+        Returns: the object and its line number in the table.'''
+        line_number = index.get(key)
+        if line_number is None:
+            return None
+        obj = self.__cache.get((file_name, key))
+        if obj is None:
+            obj = self.__decode(file_name, self.__read_record(file_name, line_number))
+            self.__cache.put((file_name, key), obj)
+        return self.__copy(obj), line_number
+
+    def __write_obj(self, file_name: str, line_number: int, obj: Model | Car | Sale) -> None:
+        '''Overwrite a record of a table with an object and update the object in the cache.'''
+        self.__write_record(file_name, line_number, self.__encode(file_name, obj))
+        self.__cache.put((file_name, getattr(obj, self.__key_fields[file_name])), self.__copy(obj))
 
     def __find_car_by_vin(self, vin: str) -> tuple[Car, int] | None:
         '''Find a car record by vin in a table and create a car object.\n
         Returns: car object and it's index in table cars.txt.'''
-        obj_line = self.__find_record_of_obj(vin, 'cars.txt', self.__car_indexes)
-        return (Car.make_object(obj_line[0]), obj_line[1]) if obj_line else None
+        return self.__find_obj(vin, 'cars.txt', self.__car_indexes)
 
     def __find_model_by_id(self, model_id: int) -> Model | None:
         '''Find a model record by id in a table and create a model object.'''
-        obj_line = self.__find_record_of_obj(model_id, 'models.txt', self.__model_indexes)
-        return Model.make_object(obj_line[0]) if obj_line else None
+        obj_line = self.__find_obj(model_id, 'models.txt', self.__model_indexes)
+        return obj_line[0] if obj_line else None
 
     def __find_sale_by_car_vin(self, car_vin: str) -> Sale | None:
         '''Find a sale record by vin in a table and create a sale object.'''
-        obj_line = self.__find_record_of_obj(car_vin, 'sales.txt', self.__sale_indexes)
-        return Sale.make_object(obj_line[0]) if obj_line else None
-
-    def __add_to_index_file(self, elem: int | str, file_name: str, dict: SortedDict) -> None:
-        '''Add an item to an index file.'''
-        with open(self.root_directory_path + "/" + file_name, "w") as f:
-            dict[elem] = len(dict)
-            arr = []
-            for i in dict.items():
-                record = db.make_record(self.__index_record_len, i[0], i[1])
-                arr.append(record)
-            f.writelines(arr)
-
-    def __init__(self, root_directory_path: str) -> None:
+        obj_line = self.__find_obj(car_vin, 'sales.txt', self.__sale_indexes)
+        return obj_line[0] if obj_line else None
+
+    def __is_not_empty(self, file_name: str) -> bool:
+        return os.path.getsize(self.root_directory_path + "/" + file_name) > 0
+
+    def __table_size(self, file_name: str) -> int:
+        '''Count records in a table using its file size.'''
+        file_size = os.path.getsize(self.root_directory_path + "/" + file_name)
+        return file_size // self.__formats[file_name].record_size
+
+    def __add_records(self, op: str, file_name: str, index: TableIndex | BTreeIndex,
+                      objects: Iterable[Model | Car | Sale], key: Callable, on_chunk: Callable | None = None) -> int:
+        '''Append records of objects to a table and add them to an index.\n
+        Objects are logged as operation `op` and written in chunks, every chunk
+        with one buffered write and one journal write. `on_chunk` is called with
+        the objects of every chunk and their line numbers to apply the rest of
+        the operation.\n
+        Returns: number of added objects.'''
+        f = self.__table(file_name)
+        line_number = f.seek(0, os.SEEK_END) // self.__formats[file_name].record_size
+        count = 0
+        it = iter(objects)
+        while chunk := list(islice(it, self.bulk_chunk_size)):
+            records = [self.__encode(file_name, obj) for obj in chunk]
+            with self.__logged(op, [obj.model_dump(mode='json') for obj in chunk]):
+                f.seek(0, os.SEEK_END)
+                f.writelines(records)
+                f.flush()
+                if self.__metrics:
+                    self.__count_io('bytes_written', sum(map(len, records)))
+                line_numbers = range(line_number, line_number + len(chunk))
+                index.set_many([(key(obj), line) for obj, line in zip(chunk, line_numbers)])
+                for obj in chunk:
+                    self.__cache.invalidate((file_name, key(obj)))
+                if on_chunk:
+                    on_chunk(chunk, line_numbers)
+            line_number += len(chunk)
+            count += len(chunk)
+        return count
+
+    def __load_index(self, index: TableIndex | BTreeIndex, table_name: str,
+                     make_entry: Callable[[list[Any], int], tuple[int | str, int | str]],
+                     keyed_by_line: bool = False) -> None:
+        '''Load an index file and its journal into memory.\n
+        The index is rebuilt by a single scan of the table if the index file
+        is missing or doesn't match the table. `make_entry` makes an index entry
+        from the raw fields of a record and its line number.'''
+        table_size = self.__table_size(table_name)
+        index.load()
+        if isinstance(index, BTreeIndex):
+            # a tree isn't read as a whole, it's checked by its header
+            stale = not index.clean or len(index) != table_size
+        else:
+            line_numbers = index.keys() if keyed_by_line else index.values()
+            stale = len(index) != table_size or any(line_number >= table_size for line_number in line_numbers)
+        if not stale:
+            return
+
+        # rebuilding the index from the table
+        index.rebuild(make_entry(fields, line_number) for line_number, fields in self.__scan_fields(table_name))
+
+    def __load_sale_indexes(self) -> None:
+        '''Load the sales index, the free slots of the sales table and the sales date index.\n
+        They are rebuilt by a single scan of the table if they don't match it.'''
+        table_size = self.__table_size('sales.txt')
+        self.__sale_indexes.load()
+        self.__free_sales.load()
+        self.__sale_dates.load()
+        if isinstance(self.__sale_indexes, BTreeIndex):
+            # a tree isn't read as a whole, the free slots and the dates are checked against its size
+            stale = (not self.__sale_indexes.clean
+                     or len(self.__sale_indexes) + len(self.__free_sales) != table_size
+                     or len(self.__sale_dates) != len(self.__sale_indexes)
+                     or any(line_number >= table_size for line_number in self.__free_sales.keys())
+                     or any(line_number >= table_size for line_number in self.__sale_dates.keys())
+                     or not set(self.__free_sales.keys()).isdisjoint(self.__sale_dates.keys()))
+        else:
+            line_numbers = set(self.__sale_indexes.values())
+            line_numbers.update(self.__free_sales.keys())
+            stale = (len(line_numbers) != table_size
+                     or len(self.__sale_indexes) + len(self.__free_sales) != table_size
+                     or any(line_number >= table_size for line_number in line_numbers)
+                     or set(self.__sale_dates.keys()) != set(self.__sale_indexes.values()))
+        if not stale:
+            return
+
+        # rebuilding the indexes from the table
+        parse = self.__formats['sales.txt'].parse
+        sales: list[tuple[str, int]] = []
+        free: list[tuple[int, int]] = []
+        dates: list[tuple[int, datetime]] = []
+        for line_number, fields in self.__scan_fields('sales.txt'):
+            if fields:
+                sales.append((fields[1], line_number))
+                dates.append((line_number, parse(2, fields[2])))
+            else:
+                free.append((line_number, line_number))
+        self.__sale_indexes.rebuild(sales)
+        self.__free_sales.rebuild(free)
+        self.__sale_dates.rebuild(dates)
+
+    def __load_model_sales(self) -> None:
+        '''Load the numbers of sales of models.\n
+        The counters are rebuilt by a scan of the cars and the sales tables
+        if they don't match the sales index.'''
+        self.__model_sales.load()
+        counters = [self.__parse_sales_counter(value) for value in self.__model_sales.values()]
+        self.__sales_seq = max((seq for _, seq in counters), default=0)
+        if sum(count for count, _ in counters) == len(self.__sale_indexes) and all(count > 0 for count, _ in counters):
+            return
+
+        # rebuilding the counters from the tables
+        car_models: dict[str, int] = {}
+        for _, fields in self.__scan_fields('cars.txt'):
+            if fields[0] in self.__sale_indexes:
+                car_models[fields[0]] = int(fields[1])
+        model_sales: dict[int, tuple[int, int]] = {}
+        for line_number, fields in self.__scan_fields('sales.txt'):
+            if not fields:  # if it's a removed sale
+                continue
+            model_id = car_models.get(fields[1])
+            if model_id is not None:
+                # a model keeps the line of its first sale, seqs start from 1
+                count, seq = model_sales.get(model_id, (0, line_number + 1))
+                model_sales[model_id] = (count + 1, seq)
+        self.__model_sales.rebuild((model_id, f'{count}#{seq}') for model_id, (count, seq) in model_sales.items())
+        self.__sales_seq = max((seq for _, seq in model_sales.values()), default=0)
+
+    @staticmethod
+    def __parse_sales_counter(value: str) -> tuple[int, int]:
+        '''Parse a sales counter of a model.\n
+        The counters are stored as "count#seq", where seq stands for the time
+        of the first sale of the model and orders models with the same count.'''
+        count, seq = value.split('#')
+        return int(count), int(seq)
+
+    def __count_model_sales(self, model_ids: Iterable[int], delta: int) -> None:
+        '''Change the numbers of sales of models by `delta` for every model id.'''
+        counters: dict[int, list[int]] = {}
+        for model_id in model_ids:
+            if model_id not in counters:
+                value = self.__model_sales.get(model_id)
+                counters[model_id] = list(self.__parse_sales_counter(value)) if value else [0, 0]
+            counters[model_id][0] += delta
+
+        entries: list[tuple[int, str]] = []
+        for model_id, (count, seq) in counters.items():
+            if not seq:  # the first sale of the model
+                # a clock in microseconds that never goes back, so that seqs of the shards
+                # of a sharded database are comparable
+                self.__sales_seq = max(self.__sales_seq + 1, time.time_ns() // 1000)
+                seq = self.__sales_seq
+            if count > 0:
+                entries.append((model_id, f'{count}#{seq}'))
+            elif model_id in self.__model_sales:
+                self.__model_sales.remove(model_id)
+        if entries:
+            self.__model_sales.set_many(entries)
+
+    @staticmethod
+    def __iter_lines(lines: SortedSet, after: int | None = None) -> Iterator[int]:
+        '''Iterate over line numbers of an index lazily, starting after the line `after`.\n
+        The next line number is searched after yielding the previous one,
+        so the index can be changed during the iteration.'''
+        it = iter(lines) if after is None else lines.irange(minimum=after, inclusive=(False, True))
+        while True:
+            line_number = next(it, None)
+            if line_number is None:
+                return
+            yield line_number
+            it = lines.irange(minimum=line_number, inclusive=(False, True))
+
+    def __set_car_status(self, line_number: int, status: CarStatus) -> None:
+        '''Save a new status of a car in the status index.'''
+        old_status = self.__car_statuses.get(line_number)
+        if old_status is not None:
+            self.__status_rows[old_status].discard(line_number)
+        self.__status_rows[status].add(line_number)
+        self.__car_statuses.set(line_number, status)
+
+    def __move_sale(self, vin: str, new_vin: str) -> None:
+        '''Move a sale of a car to its new vin.'''
+        sale_line = self.__sale_indexes.get(vin)
+        if sale_line is None:
+            return
+        sale = self.__decode('sales.txt', self.__read_record('sales.txt', sale_line))
+        sale.sales_number = sale.sales_number.split('#')[0] + '#' + new_vin
+        sale.car_vin = new_vin
+        self.__write_obj('sales.txt', sale_line, sale)
+        self.__cache.invalidate(('sales.txt', vin))
+        self.__sale_indexes.remove(vin)
+        self.__sale_indexes.set(new_vin, sale_line)
+
+    def __truncate_torn_record(self, file_name: str) -> None:
+        '''Remove an incomplete record left at the end of a table by a crash.'''
+        file_path = self.root_directory_path + "/" + file_name
+        file_size = os.path.getsize(file_path)
+        torn_size = file_size % self.__formats[file_name].record_size
+        if torn_size:
+            os.truncate(file_path, file_size - torn_size)
+
+    @contextmanager
+    def __logged(self, op: str, args: Any) -> Iterator[None]:
+        '''Write an operation to the write-ahead log before it's applied
+        and mark it as applied when it's done.\n
+        Operations replayed from the log aren't logged again. An applied
+        operation is written to the change log when it's on.'''
+        if self.__replaying:
+            yield
+            return
+        if len(self.__wal) >= self.wal_checkpoint_size:
+            self.__checkpoint_wal()
+        entry_id = self.__wal.append(op, args)
+        try:
+            yield
+            if self.__changes:
+                self.__changes.append(op, args)
+        finally:
+            self.__wal.mark_applied(entry_id)
+
+    def __sync_tables(self) -> None:
+        '''Force the tables and the index journals to disk.'''
+        for f in self.__files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        for index in self.__indexes:
+            index.sync()
+        if self.__changes:
+            self.__changes.sync()
+
+    def __checkpoint_wal(self) -> None:
+        '''Force the tables and the index journals to disk and empty the write-ahead log
+        if it has no operations left without markers by other processes.'''
+        self.__sync_tables()
+        self.__wal.truncate()
+
+    def __repair_car_status(self, vin: str, status: CarStatus) -> None:
+        '''Set a status of a car in its record and in the status index if it wasn't set.'''
+        car_index = self.__find_car_by_vin(vin)
+        if not car_index:
+            return
+        car, line_number = car_index
+        if car.status != status:
+            car.status = status
+            self.__write_obj('cars.txt', line_number, car)
+        if self.__car_statuses.get(line_number) != status:
+            self.__set_car_status(line_number, status)
+
+    def __replay(self, op: str, args: Any) -> None:
+        '''Apply an operation from the write-ahead log again.\n
+        Parts of the operation that were applied before a crash are skipped,
+        so replaying an operation more than once doesn't change the database.'''
+        if op == 'add_model':
+            if args['id'] not in self.__model_indexes:
+                self.add_model(Model.model_validate(args))
+        elif op == 'add_models':
+            self.add_models(model for model in map(Model.model_validate, args)
+                            if model.id not in self.__model_indexes)
+        elif op == 'add_car':
+            if args['vin'] not in self.__car_indexes:
+                self.add_car(Car.model_validate(args))
+        elif op == 'add_cars':
+            self.add_cars(car for car in map(Car.model_validate, args) if car.vin not in self.__car_indexes)
+        elif op in ('sell_car', 'sell_cars'):
+            sales = [Sale.model_validate(sale) for sale in (args if op == 'sell_cars' else [args])]
+            self.sell_cars(sale for sale in sales if sale.car_vin not in self.__sale_indexes)
+            for sale in sales:
+                self.__repair_car_status(sale.car_vin, CarStatus.sold)
+        elif op == 'update_vin':
+            vin, new_vin = args['vin'], args['new_vin']
+            if new_vin in self.__car_indexes:
+                car, line_number = self.__find_car_by_vin(new_vin)
+                if car.vin != new_vin:
+                    car.vin = new_vin
+                    self.__write_obj('cars.txt', line_number, car)
+                self.__move_sale(vin, new_vin)
+            elif vin in self.__car_indexes:
+                self.update_vin(vin, new_vin)
+        elif op == 'revert_sale':
+            vin = args.split('#')[1]
+            if vin in self.__sale_indexes:
+                self.revert_sale(args)
+            else:
+                self.__repair_car_status(vin, CarStatus.available)
+        else:
+            raise ValueError(f"Unknown operation in the write-ahead log: {op}")
+
+    def __recover(self) -> None:
+        '''Replay the operations of the write-ahead log left without markers
+        by crashed processes and mark them as applied.'''
+        for entry_id, op, args in self.__wal.catch_up():
+            self.__replaying = True
+            try:
+                self.__replay(op, args)
+            finally:
+                self.__replaying = False
+            # the operation may have been written to the change log before the crash
+            if self.__changes:
+                self.__changes.append(op, args, replayed=True)
+            self.__wal.mark_applied(entry_id)
+
+    def __primary_index(self, name: str, key_type: type) -> TableIndex | BTreeIndex:
+        '''Make a primary index of the chosen backend.\n
+        Memory and compact indexes are stored in the same files.'''
+        path = self.root_directory_path + "/" + name
+        if self.index_backend == 'btree':
+            return BTreeIndex(path + ".btree", key_type, self.__index_record_len)
+        if self.index_backend == 'compact':
+            return CompactIndex(path + ".txt", key_type, self.__index_record_len)
+        return TableIndex(path + ".txt", key_type, self.__index_record_len)
+
+    def __remove_other_backend(self) -> None:
+        '''Remove primary index files of the other backend, so that they're
+        rebuilt and not used stale if the backend is switched back.'''
+        suffixes = (".txt", "_journal.txt") if self.index_backend == 'btree' else (".btree",)
+        for name in ("models_index", "cars_index", "sales_index"):
+            for suffix in suffixes:
+                path = self.root_directory_path + "/" + name + suffix
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def __init__(self, root_directory_path: str, storage_format: str | None = None,
+                 record_len: int | None = None, group_commit_size: int = 100,
+                 cache_size: int = 64 << 20, metrics: bool = False, scan_workers: int = 1,
+                 index_backend: str = 'memory', cdc: bool = False) -> None:
+        '''Open a database in a directory.\n
+        `storage_format` is "text" (default) or "binary", `record_len` is
+        the length of text records (500 by default). They are saved in
+        storage.txt when the database is created and must match it later.
+        Operations are written to a write-ahead log that is forced to disk
+        once for every `group_commit_size` operations or 10 ms, a power loss
+        is recovered from only with `group_commit_size` 1 (see `WriteAheadLog`).
+        Objects read by primary keys are kept in an LRU cache that takes at
+        most `cache_size` bytes, 0 turns the cache off. With `metrics` on,
+        calls of the methods and file I/O are measured (see `stats`). Full
+        scans of big tables by `query` are run by `scan_workers` processes.
+        `index_backend` of the primary indexes is "memory" for SortedDicts
+        (see `TableIndex`), "compact" for packed arrays that take several times
+        less memory (see `CompactIndex`) or "btree" for on-disk B-trees (see
+        `BTreeIndex`). With `cdc` on, applied operations are written in order
+        to the change log cdc.txt that read replicas follow (see `ChangeLog`
+        and `ReadReplicaCarService`).'''
         self.root_directory_path = root_directory_path
-        # length of records in the database
-        self.__record_len = 500
+        self.scan_workers = scan_workers
+        # workers of full scans, the pool lives as long as the service and its workers are forked by a fork server
+        self.__scan_pool = ScanPool(scan_workers) if scan_workers > 1 else None
         self.__index_record_len = 30
-        # size of whitespace (depends on operating system)
-        self.__ws_size = 2 if os.name == 'nt' else 1
+        self.__metrics = Metrics() if metrics else None
         # database initialization (creating tables)
         open(self.root_directory_path + "/models.txt", "a").close()
-        open(self.root_directory_path + "/models_index.txt", 'a').close()
         open(self.root_directory_path + "/cars.txt", "a").close()
-        open(self.root_directory_path + "/cars_index.txt", 'a').close()
         open(self.root_directory_path + "/sales.txt", "a").close()
-        open(self.root_directory_path + "/sales_index.txt", 'a').close()
-        self.__model_indexes = SortedDict()
-        self.__car_indexes = SortedDict()
-        self.__sale_indexes = SortedDict()
+        settings = read_settings(self.root_directory_path)
+        if settings is None and any(self.__is_not_empty(file_name)
+                                    for file_name in ('models.txt', 'cars.txt', 'sales.txt')):
+            # a database created before the settings were saved
+            settings = ('text', 500)
+        if settings is None:
+            settings = (storage_format or 'text', record_len or 500)
+            write_settings(self.root_directory_path, *settings)
+        elif storage_format not in (None, settings[0]) or record_len not in (None, settings[1]):
+            raise ValueError(f"Database is stored in format {settings[0]} with records of length {settings[1]}")
+        self.storage_format, self.__record_len = settings
+        # formats of records of the tables
+        self.__formats = make_formats(self.storage_format, self.__record_len)
+        # long-lived handles of the tables
+        self.__files: dict[str, BinaryIO] = {}
+        self.__files_lock = threading.Lock()
+        # decoded objects by table file names and primary keys
+        self.__cache = LRUCache(cache_size)
+        self.__key_fields = {'models.txt': 'id', 'cars.txt': 'vin', 'sales.txt': 'car_vin'}
+        # readers-writer lock shared by the threads and the processes using the database
+        self.__lock = ReadWriteLock(self.root_directory_path + "/lock.txt")
+        # number of changes of the database, it's increased by every writer
+        # and tells other processes that they need to refresh their indexes
+        self.__version_fd = os.open(self.root_directory_path + "/version.txt", os.O_RDWR | os.O_CREAT)
+        self.__version = 0
+        if index_backend not in ('memory', 'compact', 'btree'):
+            raise ValueError(f"Unknown index backend: {index_backend}")
+        self.index_backend = index_backend
+        self.__model_indexes = self.__primary_index("models_index", int)
+        self.__car_indexes = self.__primary_index("cars_index", str)
+        self.__sale_indexes = self.__primary_index("sales_index", str)
+        # line numbers of removed sales, their slots are reused by new sales
+        self.__free_sales = TableIndex(self.root_directory_path + "/sales_free_index.txt",
+                                       int, self.__index_record_len)
+        # aggregate: model id -> number of sales of the model
+        self.__model_sales = TableIndex(self.root_directory_path + "/models_sales_index.txt",
+                                        int, self.__index_record_len, str)
+        # secondary index: line number of a car -> status of the car
+        self.__car_statuses = TableIndex(self.root_directory_path + "/cars_status_index.txt",
+                                         int, self.__index_record_len, CarStatus)
+        # secondary index: line number of a sale -> date of the sale
+        self.__sale_dates = TableIndex(self.root_directory_path + "/sales_date_index.txt",
+                                       int, 40, datetime.fromisoformat)
+        self.__indexes = [self.__model_indexes, self.__car_indexes, self.__sale_indexes,
+                          self.__free_sales, self.__car_statuses, self.__model_sales, self.__sale_dates]
+        # tables available for queries: name -> class, file, primary index and its key field
+        self.__tables: dict[str, tuple[type[Model | Car | Sale], str, TableIndex | BTreeIndex, str]] = {
+            'models': (Model, 'models.txt', self.__model_indexes, 'id'),
+            'cars': (Car, 'cars.txt', self.__car_indexes, 'vin'),
+            'sales': (Sale, 'sales.txt', self.__sale_indexes, 'car_vin'),
+        }
+        # status -> line numbers of cars with this status
+        self.__status_rows: dict[CarStatus, SortedSet] = {status: SortedSet() for status in CarStatus}
+        # dates and line numbers of sales ordered by date
+        self.__sales_by_date = SortedList()
+        # operations are logged before they are applied and replayed after a crash
+        self.__wal = WriteAheadLog(self.root_directory_path + "/wal.txt", group_commit_size,
+                                   before_sync=self.__sync_tables, flush=self.__flush_wal)
+        self.__replaying = False
+        # change data capture: applied operations in the order they were applied,
+        # the log is opened by `__load` holding the lock since its torn tail is cut off
+        self.cdc = cdc
+        self.__changes: ChangeLog | None = None
+        # columnar snapshot of the tables for analytics, it's made by the first `aggregate`
+        self.__snapshot: Snapshot | None = None
+        self.__snapshot_lock = threading.Lock()
+        # table file name -> lines overwritten since the snapshot was refreshed
+        self.__changed_lines: dict[str, set[int]] = {}
+        if self.__metrics:
+            for index in self.__indexes:
+                index.metrics = self.__metrics
+            # timed wrappers shadow the methods only in this object, so there's no overhead without metrics
+            for name in self.timed_methods:
+                setattr(self, name, self.__metrics.timed(name, getattr(self, name)))
+        with self.__lock.write():
+            self.__load()
+
+    def __load(self) -> None:
+        '''Load the indexes of an existing database and recover it after a crash.'''
+        for file_name in self.__formats:
+            self.__truncate_torn_record(file_name)
+        self.__remove_other_backend()
+        self.__load_index(self.__model_indexes, 'models.txt', lambda fields, line: (int(fields[0]), line))
+        self.__load_index(self.__car_indexes, 'cars.txt', lambda fields, line: (fields[0], line))
+        self.__load_sale_indexes()
+        self.__load_model_sales()
+        self.__load_index(self.__car_statuses, 'cars.txt', lambda fields, line: (line, CarStatus(fields[4])),
+                          keyed_by_line=True)
+        self.__fill_status_rows()
+        self.__fill_sales_by_date()
+        self.__version = self.__read_version()
+        if self.cdc:
+            self.__changes = ChangeLog(self.root_directory_path + "/cdc.txt")
+        self.__recover()
+        self.__checkpoint_wal()
+        self.__cache.clear()
+        self.__write_version()
+
+    def __fill_status_rows(self) -> None:
+        '''Fill the line numbers of cars by statuses from the status index.'''
+        for lines in self.__status_rows.values():
+            lines.clear()
+        for line_number, status in self.__car_statuses.items():
+            self.__status_rows[status].add(line_number)
+
+    def __fill_sales_by_date(self) -> None:
+        '''Fill the sales ordered by date from the sales date index.'''
+        self.__sales_by_date.clear()
+        self.__sales_by_date.update((sales_date, line_number) for line_number, sales_date in self.__sale_dates.items())
+
+    def __set_sale_dates(self, entries: list[tuple[int, datetime]]) -> None:
+        '''Save dates of new sales in the sales date index.'''
+        self.__sale_dates.set_many(entries)
+        self.__sales_by_date.update((sales_date, line_number) for line_number, sales_date in entries)
+
+    def __remove_sale_date(self, line_number: int) -> None:
+        '''Remove a date of a removed sale from the sales date index.'''
+        sales_date = self.__sale_dates.remove(line_number)
+        self.__sales_by_date.discard((sales_date, line_number))
+
+    def __read_version(self) -> int:
+        '''Read the number of changes of the database.'''
+        return int.from_bytes(os.pread(self.__version_fd, 8, 0), 'little')
+
+    def __write_version(self) -> None:
+        '''Count a change of the database.'''
+        self.__version += 1
+        os.pwrite(self.__version_fd, self.__version.to_bytes(8, 'little'), 0)
+
+    def __refresh(self) -> None:
+        '''Catch up with the changes made by other processes.\n
+        Only the new entries of the index journals are read.'''
+        # tables may have been replaced and buffers of the handles are stale
+        for f in self.__files.values():
+            f.close()
+        self.__files.clear()
+        self.__cache.clear()
+        # records may have been overwritten by other processes
+        self.__drop_snapshot()
+        for index in self.__indexes:
+            if index not in (self.__car_statuses, self.__sale_dates):
+                index.refresh()
+        changes = self.__car_statuses.refresh()
+        if changes is None:
+            self.__fill_status_rows()
+        else:
+            for line_number, old_status, status in changes:
+                if old_status is not None:
+                    self.__status_rows[old_status].discard(line_number)
+                if status is not None:
+                    self.__status_rows[status].add(line_number)
+        changes = self.__sale_dates.refresh()
+        if changes is None:
+            self.__fill_sales_by_date()
+        else:
+            for line_number, old_date, sales_date in changes:
+                if old_date is not None:
+                    self.__sales_by_date.discard((old_date, line_number))
+                if sales_date is not None:
+                    self.__sales_by_date.add((sales_date, line_number))
+        self.__sales_seq = max((self.__parse_sales_counter(value)[1] for value in self.__model_sales.values()),
+                               default=0)
+        self.__version = self.__read_version()
+
+    @contextmanager
+    def __reading(self) -> Iterator[None]:
+        '''Hold the lock for reading with the indexes up to date.'''
+        while True:
+            with self.__lock.read():
+                if self.__read_version() == self.__version:
+                    yield
+                    return
+            with self.__lock.write():
+                if self.__read_version() != self.__version:
+                    self.__refresh()
+
+    @contextmanager
+    def __writing(self) -> Iterator[None]:
+        '''Hold the lock for writing with the indexes up to date.'''
+        with self.__lock.write():
+            if self.__read_version() != self.__version:
+                self.__refresh()
+            # a process that crashed holding the lock left its operation half done
+            # and didn't count the change, so the tables are read again before the replay
+            if not self.__replaying and self.__wal.catch_up():
+                for file_name in self.__formats:
+                    self.__truncate_torn_record(file_name)
+                self.__refresh()
+                self.__recover()
+            try:
+                yield
+            finally:
+                self.__write_version()
+
+    def __locked(self, items: Iterator[Any]) -> Iterator[Any]:
+        '''Iterate lazily holding the lock for reading only while an item is made.'''
+        while True:
+            with self.__reading():
+                item = next(items, None)
+            if item is None:
+                return
+            yield item
+
+    def stats(self) -> dict[str, Any]:
+        '''Get the metrics of the service: calls and latency histograms of
+        the methods, I/O counters and counters of the object cache.\n
+        Only the cache counters are returned when metrics are off.'''
+        stats = self.__metrics.stats() if self.__metrics else {}
+        return {**stats, 'cache': self.cache_stats()}
+
+    def prometheus_metrics(self) -> str:
+        '''Dump the metrics of the service in the Prometheus text format.\n
+        Returns: an empty string when metrics are off.'''
+        return self.__metrics.prometheus() if self.__metrics else ''
+
+    def cache_stats(self) -> dict[str, int]:
+        '''Get the hits, misses, number of entries and size in bytes of the object cache.'''
+        return self.__cache.stats()
+
+    def sync(self) -> None:
+        '''Force the logged operations to disk.'''
+        with self.__lock.write():
+            self.__wal.sync()
+
+    def __flush_wal(self) -> None:
+        '''Force a group of logged operations to disk after the delay of the group commit.'''
+        with self.__lock.write():
+            self.__wal.sync()
+
+    def close(self) -> None:
+        '''Checkpoint the write-ahead log and close the handles of the tables,
+        of the index journals and of the log.'''
+        # the background flusher of the log takes the lock, so it's stopped before
+        self.__wal.stop()
+        with self.__lock.write():
+            self.__checkpoint_wal()
+            for f in self.__files.values():
+                f.close()
+            self.__files.clear()
+            for index in self.__indexes:
+                index.close()
+            self.__wal.close()
+            if self.__changes:
+                self.__changes.close()
+        if self.__scan_pool:
+            self.__scan_pool.close()
+        self.__lock.close()
+        os.close(self.__version_fd)
+
+    def __enter__(self) -> 'CarService':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def checkpoint(self) -> None:
+        '''Rewrite all index files from their journals and empty the write-ahead log.'''
+        with self.__writing():
+            for index in self.__indexes:
+                index.checkpoint()
+            self.__checkpoint_wal()
+
+    def apply_change(self, op: str, args: Any) -> None:
+        '''Apply an operation of the change log of another database.\n
+        Operations are applied like the ones replayed from the write-ahead log,
+        so applying an operation again after a crash doesn't change the database.'''
+        with self.__writing():
+            self.__replaying = True
+            try:
+                self.__replay(op, args)
+            finally:
+                self.__replaying = False
+            if self.__changes:
+                self.__changes.append(op, args, replayed=True)
 
     # Task 1. Adding a model to the models table.
     def add_model(self, model: Model) -> Model:
         '''Add a model to the models table.'''
-        result_str = model.make_record(self.__record_len)
-        with open(self.root_directory_path + "/models.txt", "a") as f:
-            f.write(result_str)
+        with self.__writing():
+            result_str = self.__encode('models.txt', model)
+            with self.__logged('add_model', model.model_dump(mode='json')):
+                self.__append_record('models.txt', result_str)
 
-        self.__add_to_index_file(model.id, 'models_index.txt', self.__model_indexes)
+                self.__model_indexes.set(model.id, len(self.__model_indexes))
+                self.__cache.invalidate(('models.txt', model.id))
 
-        return model
+            return model
 
     # Task 1. Adding a car to the cars table.
     def add_car(self, car: Car) -> Car:
         '''Add a car to the cars table.'''
-        result_str = car.make_record(self.__record_len)
-        with open(self.root_directory_path + "/cars.txt", "a") as f:
-            f.write(result_str)
+        with self.__writing():
+            result_str = self.__encode('cars.txt', car)
+            with self.__logged('add_car', car.model_dump(mode='json')):
+                self.__append_record('cars.txt', result_str)
+
+                line_number = len(self.__car_indexes)
+                self.__car_indexes.set(car.vin, line_number)
+                self.__cache.invalidate(('cars.txt', car.vin))
+                self.__set_car_status(line_number, car.status)
 
-        self.__add_to_index_file(car.vin, 'cars_index.txt', self.__car_indexes)
+            return car
 
-        return car
+    def add_models(self, models: Iterable[Model]) -> int:
+        '''Add many models to the models table at once.\n
+        Returns: number of added models.'''
+        with self.__writing():
+            return self.__add_records('add_models', 'models.txt', self.__model_indexes, models, lambda model: model.id)
+
+    def add_cars(self, cars: Iterable[Car]) -> int:
+        '''Add many cars to the cars table at once.\n
+        Returns: number of added cars.'''
+        def add_statuses(cars: list[Car], line_numbers: range) -> None:
+            statuses = [(line_number, car.status) for car, line_number in zip(cars, line_numbers)]
+            for line_number, status in statuses:
+                self.__status_rows[status].add(line_number)
+            self.__car_statuses.set_many(statuses)
+
+        with self.__writing():
+            return self.__add_records('add_cars', 'cars.txt', self.__car_indexes, cars, lambda car: car.vin,
+                                      add_statuses)
 
     # Task 2. Save sale.
-    def sell_car(self, sale: Sale) -> Car:
+    def sell_car(self, sale: Sale) -> Car | None:
         '''Save a sale record to the sales table.'''
-        result_str = sale.make_record(self.__record_len)
-        with open(self.root_directory_path + "/sales.txt", "a") as f:
-            f.write(result_str)
-
-        self.__add_to_index_file(sale.car_vin, 'sales_index.txt', self.__sale_indexes)
-
-        car_index = self.__find_car_by_vin(sale.car_vin)
-        if car_index:
-            car, index_num = car_index
-            car.status = CarStatus('sold')
-            with open(self.root_directory_path + "/cars.txt", "r+") as f:
-                f.seek(index_num * (self.__record_len + self.__ws_size))
-                line_to_write = car.make_record(self.__record_len)
-                f.write(line_to_write)
-        return car
+        with self.__writing():
+            result_str = self.__encode('sales.txt', sale)
+            with self.__logged('sell_car', sale.model_dump(mode='json')):
+                if len(self.__free_sales):
+                    # reusing a slot of a removed sale
+                    line_number = self.__free_sales.remove(next(iter(self.__free_sales)))
+                    self.__write_record('sales.txt', line_number, result_str)
+                else:
+                    line_number = self.__table_size('sales.txt')
+                    self.__append_record('sales.txt', result_str)
+
+                self.__sale_indexes.set(sale.car_vin, line_number)
+                self.__set_sale_dates([(line_number, sale.sales_date)])
+                self.__cache.put(('sales.txt', sale.car_vin), self.__copy(sale))
+
+                car_index = self.__find_car_by_vin(sale.car_vin)
+                if not car_index:  # if the car is not found
+                    return None
+                car, index_num = car_index
+                car.status = CarStatus('sold')
+                self.__write_obj('cars.txt', index_num, car)
+                self.__set_car_status(index_num, car.status)
+                self.__count_model_sales([car.model], 1)
+            return car
+
+    def sell_cars(self, sales: Iterable[Sale]) -> int:
+        '''Save many sale records to the sales table at once.\n
+        Returns: number of saved sales.'''
+        def sell(sales: list[Sale], line_numbers: range) -> None:
+            self.__set_sale_dates([(line_number, sale.sales_date) for sale, line_number in zip(sales, line_numbers)])
+            # changing statuses of the sold cars
+            sold_models: list[int] = []
+            for sale in sales:
+                car_index = self.__find_car_by_vin(sale.car_vin)
+                if car_index:
+                    car, index_num = car_index
+                    car.status = CarStatus.sold
+                    self.__write_obj('cars.txt', index_num, car)
+                    self.__set_car_status(index_num, car.status)
+                    sold_models.append(car.model)
+            self.__count_model_sales(sold_models, 1)
+
+        with self.__writing():
+            return self.__add_records('sell_cars', 'sales.txt', self.__sale_indexes, sales,
+                                      lambda sale: sale.car_vin, sell)
+
+    def load_file(self, file_path: str, table_name: str) -> int:
+        '''Stream rows of a CSV or a JSONL file into a table.\n
+        `table_name` is one of "models", "cars" or "sales".\n
+        Returns: number of loaded rows.'''
+        loaders = {
+            'models': (self.add_models, Model),
+            'cars': (self.add_cars, Car),
+            'sales': (self.sell_cars, Sale),
+        }
+        if table_name not in loaders:
+            raise ValueError(f"Unknown table: {table_name}")
+        add, cls = loaders[table_name]
+        return add(read_objects(file_path, cls))
+
+    def query(self, table_name: str, where: dict[str, Any] | None = None,
+              fields: list[str] | None = None) -> Iterator[Model | Car | Sale | dict[str, Any]]:
+        '''Lazily find records of a table that match all conditions.\n
+        `where` maps field names to a value the field must be equal to or to
+        a predicate that takes the value of the field. Conditions are checked
+        on the fields of raw records, so objects are made only for matching
+        records. The primary index or the status index are used when there is
+        an equality condition on their field. Otherwise the table is scanned,
+        by a pool of `scan_workers` processes if it has at least
+        `parallel_scan_size` records and the predicates can be pickled
+        (e.g. module-level functions, not lambdas).\n
+        Returns: objects of the table or, if `fields` are given, dicts with
+        values of these fields.'''
+        return self.__locked(self.__query(table_name, where, fields))
+
+    def __query(self, table_name: str, where: dict[str, Any] | None,
+                fields: list[str] | None) -> Iterator[Model | Car | Sale | dict[str, Any]]:
+        '''Find records of a table that match all conditions (see `query`).'''
+        if table_name not in self.__tables:
+            raise ValueError(f"Unknown table: {table_name}")
+        cls, file_name, index, key_field = self.__tables[table_name]
+        fmt = self.__formats[file_name]
+        field_names = list(cls.model_fields)
+        where = where or {}
+        for name in [*where, *(fields or [])]:
+            if name not in cls.model_fields:
+                raise ValueError(f"Unknown field of {table_name}: {name}")
+        conditions = [(field_names.index(name), condition) for name, condition in where.items()]
+
+        # choosing records to check
+        records: Iterable[tuple[int, bytes]] | None
+        if key_field in where and not callable(where[key_field]):
+            key = where[key_field]
+            line_number = index.get(key)
+            records = [] if line_number is None else [(line_number, self.__read_record(file_name, line_number))]
+        elif table_name == 'cars' and 'status' in where and not callable(where['status']):
+            records = ((line_number, self.__read_record(file_name, line_number))
+                       for line_number in self.__iter_lines(self.__status_rows[CarStatus(where['status'])]))
+        else:
+            records = None
+        select = RecordFilter(fmt, conditions, fields)
+        if (records is None and self.__scan_pool and self.__table_size(file_name) >= self.parallel_scan_size
+                and select.picklable()):
+            # ranges of the table are filtered by the workers while the results of the previous ones are yielded
+            file_path = self.root_directory_path + "/" + file_name
+            for read, results in self.__scan_pool.scan(file_path, self.__lock.file_path, select):
+                if self.__metrics:
+                    self.__metrics.count('bytes_read', read * fmt.record_size)
+                yield from results
+            return
+        if records is None:
+            records = self.__scan_records(file_name)
+        for _, record in records:
+            result = select(record)
+            if result is not None:
+                yield result
+
+    def iter_cars(self, status: CarStatus, after: str | None = None) -> Iterator[Car]:
+        '''Lazily iterate over the cars with a status in the order of the cars table.\n
+        `after` is a vin of a car the iteration starts after.'''
+        return self.__locked(self.__iter_cars(status, after))
+
+    def __iter_cars(self, status: CarStatus, after: str | None) -> Iterator[Car]:
+        '''Iterate over the cars with a status (see `iter_cars`).'''
+        after_line = None
+        if after is not None:
+            after_line = self.__car_indexes.get(after)
+            if after_line is None:
+                raise ValueError(f"Unknown vin: {after}")
+        for line_number in self.__iter_lines(self.__status_rows[CarStatus(status)], after_line):
+            yield self.__decode('cars.txt', self.__read_record('cars.txt', line_number))
 
     # Task 3. Cars available for sale.
-    def get_cars(self, status: CarStatus) -> list[Car]:
-        '''Get all the cars available for sale.'''
-        available_cars = []
-        with open(self.root_directory_path + "/cars.txt", 'r') as f:
-            while True:
-                line = f.readline()
-                if not line:  # if it's end of file
-                    break
-                if status in line:
-                    car = Car.make_object(line)
-                    available_cars.append(car)
-        return available_cars
+    def get_cars(self, status: CarStatus, limit: int | None = None, after: str | None = None) -> list[Car]:
+        '''Get the cars with a status.\n
+        Only the records found in the status index are read. A page of at most
+        `limit` cars starts after the car with vin `after`, so the vin of the
+        last car of a page is the cursor of the next one.'''
+        with self.__reading():
+            return list(islice(self.__iter_cars(status, after), limit))
 
     # Task 4. Detailed information.
     def get_car_info(self, vin: str) -> CarFullInfo | None:
         '''Get detailed information about a car by vin.'''
-        sales_date: datetime | None = None
-        sales_cost: Decimal | None = None
+        with self.__reading():
+            sales_date: datetime | None = None
+            sales_cost: Decimal | None = None
 
-        # looking for a car
-        car_index = self.__find_car_by_vin(vin)
-        if not car_index:  # if the car is not found
-            return None
+            # looking for a car
+            car_index = self.__find_car_by_vin(vin)
+            if not car_index:  # if the car is not found
+                return None
 
-        car, _ = car_index
-        # looking for a model name and brand
-        model = self.__find_model_by_id(car.model)
-        if not model:  # if the model is not found
-            return None
+            car, _ = car_index
+            # looking for a model name and brand
+            model = self.__find_model_by_id(car.model)
+            if not model:  # if the model is not found
+                return None
+
+            # looking for a sale if exists
+            if car.status == CarStatus.sold:
+                sale = self.__find_sale_by_car_vin(vin)
+                if sale:
+                    sales_date = sale.sales_date
+                    sales_cost = sale.cost
+
+            return CarFullInfo(
+                vin=vin,
+                car_model_name=model.name,
+                car_model_brand=model.brand,
+                price=car.price,
+                date_start=car.date_start,
+                status=car.status,
+                sales_date=sales_date,
+                sales_cost=sales_cost,
+            )
+
+    def __read_objects(self, file_name: str, lines: dict[Any, int]) -> dict[Any, Any]:
+        '''Get objects of a table by their primary keys and line numbers.\n
+        Objects that aren't cached are read in the order of their offsets,
+        records on consecutive lines are read at once.\n
+        Returns: primary key -> object.'''
+        objects: dict[Any, Any] = {}
+        missing: list[tuple[int, Any]] = []
+        for key, line_number in lines.items():
+            obj = self.__cache.get((file_name, key))
+            if obj is None:
+                missing.append((line_number, key))
+            else:
+                objects[key] = obj
+        missing.sort()
+
+        record_size = self.__formats[file_name].record_size
+        fd = self.__table(file_name).fileno()
+        start = 0
+        while start < len(missing):
+            # a run of records on consecutive lines
+            end = start + 1
+            while end < len(missing) and missing[end][0] == missing[end - 1][0] + 1:
+                end += 1
+            data = os.pread(fd, (end - start) * record_size, missing[start][0] * record_size)
+            if self.__metrics:
+                self.__count_io('bytes_read', len(data))
+            for i, (_, key) in enumerate(missing[start:end]):
+                obj = self.__decode(file_name, data[i * record_size:(i + 1) * record_size])
+                self.__cache.put((file_name, key), obj)
+                objects[key] = obj
+            start = end
+        return objects
+
+    def get_car_info_many(self, vins: Iterable[str]) -> list[CarFullInfo | None]:
+        '''Get detailed information about many cars by vins.\n
+        Every table is read once in the order of the offsets of the records,
+        every distinct model and car is read only once.\n
+        Returns: information in the order of the vins, None for cars that aren't found.'''
+        vins = list(vins)
+        with self.__reading():
+            cars = self.__read_objects('cars.txt', {vin: self.__car_indexes[vin] for vin in set(vins)
+                                                    if vin in self.__car_indexes})
+            model_ids = {car.model for car in cars.values()}
+            models = self.__read_objects('models.txt', {model_id: self.__model_indexes[model_id]
+                                                        for model_id in model_ids if model_id in self.__model_indexes})
+            sold = [vin for vin, car in cars.items() if car.status == CarStatus.sold]
+            sales = self.__read_objects('sales.txt', {vin: self.__sale_indexes[vin] for vin in sold
+                                                      if vin in self.__sale_indexes})
+
+        infos: list[CarFullInfo | None] = []
+        for vin in vins:
+            car = cars.get(vin)
+            model = models.get(car.model) if car else None
+            if not model:  # if the car or its model is not found
+                infos.append(None)
+                continue
+            sale = sales.get(vin)
+            infos.append(CarFullInfo(
+                vin=vin,
+                car_model_name=model.name,
+                car_model_brand=model.brand,
+                price=car.price,
+                date_start=car.date_start,
+                status=car.status,
+                sales_date=sale.sales_date if sale else None,
+                sales_cost=sale.cost if sale else None,
+            ))
+        return infos
+
+    def __sale_lines(self, start: datetime, end: datetime) -> list[int]:
+        '''Find line numbers of the sales made from `start` up to `end` by bisection of the date index.'''
+        return [line_number for _, line_number in self.__sales_by_date.irange((start,), (end,))]
+
+    def get_sales(self, start: datetime, end: datetime) -> list[Sale]:
+        '''Get the sales made from `start` up to but not including `end` ordered by date.\n
+        Only the records of the sales found in the sales date index are read.'''
+        with self.__reading():
+            return [self.__decode('sales.txt', self.__read_record('sales.txt', line_number))
+                    for line_number in self.__sale_lines(start, end)]
+
+    def revenue(self, start: datetime, end: datetime) -> Decimal:
+        '''Sum the costs of the sales made from `start` up to but not including `end`.\n
+        Only the cost fields of the records found in the sales date index are parsed.'''
+        fmt = self.__formats['sales.txt']
+        with self.__reading():
+            return sum((fmt.parse(3, fmt.split(self.__read_record('sales.txt', line_number))[3])
+                        for line_number in self.__sale_lines(start, end)), Decimal(0))
 
-        # looking for a sale if exists
-        if car.status == CarStatus.sold:
-            sale = self.__find_sale_by_car_vin(vin)
-            if sale:
-                sales_date = sale.sales_date
-                sales_cost = sale.cost
-
-        return CarFullInfo(
-            vin=vin,
-            car_model_name=model.name,
-            car_model_brand=model.brand,
-            price=car.price,
-            date_start=car.date_start,
-            status=car.status,
-            sales_date=sales_date,
-            sales_cost=sales_cost,
-        )
+    def aggregate(self, group_by: list[str],
+                  metrics: dict[str, tuple[str, str | Callable[[dict[str, Any]], Any] | None]],
+                  table: str = 'sales') -> list[dict[str, Any]]:
+        '''Group the records of a table and compute metrics of the groups.\n
+        Sales are joined with their cars and models, cars with their models.
+        `group_by` are column names, a datetime column can be truncated with
+        a suffix ".year", ".month" or ".day", e.g. "sales_date.month". `metrics`
+        map result names to a function ("count", "sum", "mean", "min" or "max")
+        and a column name or a callable that takes a dict of NumPy columns and
+        returns an array; decimals are int64 in hundredths in these columns.
+        The tables are decoded into a columnar snapshot once, later calls only
+        read new and overwritten records. Requires numpy.\n
+        Returns: dicts with the group keys and the metrics ordered by the keys.'''
+        with self.__reading(), self.__snapshot_lock:
+            if self.__snapshot is None:
+                self.__changed_lines.clear()
+                self.__snapshot = Snapshot(self.root_directory_path, self.__formats)
+            else:
+                self.__snapshot.refresh(self.__changed_lines)
+                self.__changed_lines.clear()
+            return self.__snapshot.aggregate(table, group_by, metrics)
+
+    def __drop_snapshot(self) -> None:
+        '''Drop the columnar snapshot, it's made again by the next `aggregate`.'''
+        self.__snapshot = None
+        self.__changed_lines.clear()
 
     # Task 5. Updating key field.
     def update_vin(self, vin: str, new_vin: str) -> Car | None:
         '''Update a vin number.'''
-        # looking for a car
-        car_index = self.__find_car_by_vin(vin)
-        if car_index:
-            car, car_line = car_index
-        else:
-            return None
+        with self.__writing():
+            # looking for a car
+            car_index = self.__find_car_by_vin(vin)
+            if car_index:
+                car, car_line = car_index
+            else:
+                return None
 
-        # rewriting indexes
-        with open(self.root_directory_path + "/cars_index.txt", "w") as f:
-            self.__car_indexes.pop(car.vin)
-            self.__car_indexes[new_vin] = car_line
-            arr = []
-            for i in self.__car_indexes.items():
-                record = db.make_record(self.__index_record_len, i[0], i[1])
-                arr.append(record)
-            f.writelines(arr)
-
-        with open(self.root_directory_path + "/cars.txt", "r+") as f:
-            f.seek(car_line * (self.__record_len + self.__ws_size))
-            car.vin = new_vin
-            line_to_write = car.make_record(self.__record_len)
-            f.write(line_to_write)
-        return car
+            with self.__logged('update_vin', {'vin': vin, 'new_vin': new_vin}):
+                # updating indexes
+                self.__car_indexes.remove(car.vin)
+                self.__car_indexes.set(new_vin, car_line)
+                self.__cache.invalidate(('cars.txt', vin))
+
+                car.vin = new_vin
+                self.__write_obj('cars.txt', car_line, car)
+                self.__move_sale(vin, new_vin)
+            return car
 
     # Task 6. Removing sale.
-    def revert_sale(self, sales_number: str) -> Car:
+    def revert_sale(self, sales_number: str) -> Car | None:
         '''Remove a sale record from sales.txt.'''
-        # removing record from index file
-        vin = sales_number.split('#')[1]
-        # line_number is the number of the line to remove in sale.txt
-        line_number = self.__sale_indexes.pop(vin)
-
-        # recalculating and rewriting indexes
-        for (key, value) in self.__sale_indexes.items():
-            if value > line_number:
-                self.__sale_indexes[key] -= 1
-        arr = []
-        for i in self.__sale_indexes.items():
-            record = db.make_record(self.__index_record_len, i[0], i[1])
-            arr.append(record)
-        with open(self.root_directory_path + "/sales_index.txt", "w") as f:
-            f.writelines(arr)
-
-        # removing a record from sales.txt
-        cur_line = line_number + 1
-        with open(self.root_directory_path + "/sales.txt", "r+") as f:
-            while True:
-                f.seek(cur_line * (self.__record_len + self.__ws_size))
-                line = f.read(self.__record_len)
-                if not line:
-                    break
-                f.seek((cur_line - 1) * (self.__record_len + self.__ws_size))
-                f.write(line)
-                cur_line += 1
-            f.seek((cur_line - 1) * (self.__record_len + self.__ws_size))
-            f.truncate()
-
-        # finding a car and changing status to available
-        car_index = self.__find_car_by_vin(vin)
-        if car_index:
-            car, index_num = car_index
-            car.status = CarStatus('available')
-            with open(self.root_directory_path + "/cars.txt", "r+") as f:
-                f.seek(index_num * (self.__record_len + self.__ws_size))
-                line_to_write = car.make_record(self.__record_len)
-                f.write(line_to_write)
-        return car
+        with self.__writing():
+            # removing record from index file
+            vin = sales_number.split('#')[1]
+            if vin not in self.__sale_indexes:
+                raise KeyError(vin)
+            with self.__logged('revert_sale', sales_number):
+                # line_number is the number of the line to remove in sale.txt
+                line_number = self.__sale_indexes.remove(vin)
+
+                # replacing the record with a tombstone, the slot is reused by new sales
+                self.__write_record('sales.txt', line_number, self.__formats['sales.txt'].tombstone())
+                self.__cache.invalidate(('sales.txt', vin))
+                self.__free_sales.set(line_number, line_number)
+                self.__remove_sale_date(line_number)
+                if len(self.__free_sales) >= max(len(self.__sale_indexes), self.min_compaction_size):
+                    self.compact_sales()
+
+                # finding a car and changing status to available
+                car_index = self.__find_car_by_vin(vin)
+                if not car_index:  # if the car is not found
+                    return None
+                car, index_num = car_index
+                car.status = CarStatus('available')
+                self.__write_obj('cars.txt', index_num, car)
+                self.__set_car_status(index_num, car.status)
+                self.__count_model_sales([car.model], -1)
+            return car
+
+    def compact_sales(self) -> None:
+        '''Remove tombstones from the sales table.\n
+        The table and its indexes are rewritten in one sequential sweep.'''
+        with self.__writing():
+            table_path = self.root_directory_path + "/sales.txt"
+            tmp_path = table_path + '.tmp'
+            fmt = self.__formats['sales.txt']
+            sales: list[tuple[str, int]] = []
+            dates: list[tuple[int, datetime]] = []
+            with open(tmp_path, "wb") as tmp:
+                for _, record in self.__scan_records('sales.txt'):
+                    fields = fmt.split(record)
+                    if fields:
+                        dates.append((len(sales), fmt.parse(2, fields[2])))
+                        sales.append((fields[1], len(sales)))
+                        tmp.write(record)
+            f = self.__files.pop('sales.txt', None)
+            if f is not None:
+                f.close()
+            os.replace(tmp_path, table_path)
+            self.__drop_snapshot()
+            self.__sale_indexes.rebuild(sales)
+            self.__free_sales.rebuild([])
+            self.__sale_dates.rebuild(dates)
+            self.__fill_sales_by_date()
 
     # Task 7. Top 3 best selling models.
-    def top_models_by_sales(self) -> list[ModelSaleStats]:
-        '''Find top 3 models by amount of sales.'''
-        model_sales_dict: dict[int, int] = {}
-
-        # getting all sold cars and adding models and their sales count
-        # to the dictionary
-        with open(self.root_directory_path + "/sales.txt", "r") as f:
-            while True:
-                line = f.readline()
-                if not line:
-                    break
-                # extracting vin number
-                sale_line = line.strip().split(';')
-                car_vin = sale_line[1]
-
-                # looking for a car
-                car_index = self.__find_car_by_vin(car_vin)
-                if car_index:
-                    car_model = car_index[0].model
-                    # adding to the dictionary
-                    model_sales_dict[car_model] = model_sales_dict[car_model] + \
-                        1 if car_model in model_sales_dict else 1
-
-        # sorting models by count of sales
-        top_3_models = sorted(model_sales_dict.items(),
-                              key=lambda x: x[1], reverse=True)[:3]
-
-        model_sale_stats: list[ModelSaleStats] = []
-
-        # joining with the models table to get name and brand of a model
-        for model_id, count in top_3_models:
-            model = self.__find_model_by_id(model_id)
-            if model:
-                model_sale_stats.append(
-                        ModelSaleStats(
-                            car_model_name=model.name,
-                            brand=model.brand,
-                            sales_number=count
+    def model_sales(self) -> dict[int, tuple[int, int]]:
+        '''Get the sales counters of the models.\n
+        Returns: model id -> number of sales and the seq of the first sale of the model.'''
+        with self.__reading():
+            return {model_id: self.__parse_sales_counter(value) for model_id, value in self.__model_sales.items()}
+
+    def top_models_by_sales(self, k: int = 3) -> list[ModelSaleStats]:
+        '''Find top k models by amount of sales.\n
+        Models with the same amount of sales are ordered by their first sales.'''
+        with self.__reading():
+            # taking top models from the sales counters
+            counters = ((model_id, *self.__parse_sales_counter(value))
+                        for model_id, value in self.__model_sales.items())
+            top_models = heapq.nsmallest(k, counters, key=lambda counter: (-counter[1], counter[2]))
+
+            model_sale_stats: list[ModelSaleStats] = []
+
+            # joining with the models table to get name and brand of a model
+            for model_id, count, _ in top_models:
+                model = self.__find_model_by_id(model_id)
+                if model:
+                    model_sale_stats.append(
+                            ModelSaleStats(
+                                car_model_name=model.name,
+                                brand=model.brand,
+                                sales_number=count
+                            )
                         )
-                    )
 
-        return model_sale_stats
+            return model_sale_stats
@@ -0,0 +1,375 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import os
+import struct
+import threading
+import time
+from typing import Iterable, Iterator
+
+from metrics import Metrics
+
+
+class _Page:
+    '''A decoded page of a B-tree.\n
+    `items` are the values of the keys in a leaf and the numbers of the
+    child pages in an internal page, which has one child more than keys.'''
+
+    __slots__ = ('leaf', 'keys', 'items', 'next')
+
+    def __init__(self, leaf: bool, keys: list[int | str], items: list[int], next_leaf: int = 0) -> None:
+        self.leaf = leaf
+        self.keys = keys
+        self.items = items
+        # number of the next leaf, 0 for the last one
+        self.next = next_leaf
+
+
+class BTreeIndex:
+    '''A primary index of a table stored as an on-disk B+ tree.\n
+    Keys are mapped to line numbers of a table. The tree is kept in a file
+    of fixed-size pages, so a lookup reads O(log n) pages and the index is
+    never loaded into memory as a whole; only the most recently used pages
+    are kept in a cache of `cache_pages` pages. Changed pages are written
+    in place. Pages aren't merged when keys are removed, `rebuild` writes
+    a compact tree.\n
+    The header of the file counts changes of the tree, so that other
+    processes drop their cached pages on `refresh`, and marks the tree as
+    dirty while it's changed, so that a tree left half-changed by a crash
+    is detected by `clean` and rebuilt from its table.'''
+
+    magic = b'BIBIPBT1'
+    # magic, page size, key length, root, number of pages, number of keys, number of changes, dirty flag
+    header = struct.Struct('>8sHHQQQQB')
+    # leaf flag, number of keys, next leaf
+    page_header = struct.Struct('>BHQ')
+
+    def __init__(self, file_path: str, key_type: type, key_len: int = 30, page_size: int = 4096,
+                 cache_pages: int = 256) -> None:
+        self.file_path = file_path
+        self.__key_type = key_type
+        self.__key_len = 8 if key_type is int else key_len
+        self.__page_size = page_size
+        self.__cache_pages = cache_pages
+        # maximal numbers of keys in a leaf and in an internal page
+        self.__leaf_capacity = (page_size - self.page_header.size) // (self.__key_len + 8)
+        self.__node_capacity = (page_size - self.page_header.size - 8) // (self.__key_len + 8)
+        self.__fd: int | None = None
+        self.__file_id: tuple[int, int] | None = None
+        self.__root = 1
+        self.__page_count = 2
+        self.__size = 0
+        self.__changes = 0
+        self.__dirty = False
+        # decoded pages by numbers, from the least to the most recently used
+        self.__pages: OrderedDict[int, _Page] = OrderedDict()
+        # pages are read by many threads holding the lock of the database for reading
+        self.__pages_lock = threading.Lock()
+        # the tree is flushed to disk when metrics are set
+        self.metrics: Metrics | None = None
+        self.clean = True
+
+    def __getitem__(self, key: int | str) -> int:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: int | str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __iter__(self) -> Iterator[int | str]:
+        return self.keys()
+
+    # encoding of pages
+
+    def __encode_key(self, key: int | str) -> bytes:
+        if self.__key_type is int:
+            return key.to_bytes(8, 'big', signed=True)
+        data = key.encode()
+        if len(data) > self.__key_len:
+            raise ValueError(f"Key is longer than {self.__key_len} bytes: {key!r}")
+        return data.ljust(self.__key_len, b'\0')
+
+    def __decode_key(self, data: bytes) -> int | str:
+        if self.__key_type is int:
+            return int.from_bytes(data, 'big', signed=True)
+        return data.rstrip(b'\0').decode()
+
+    def __encode_page(self, page: _Page) -> bytes:
+        parts = [self.page_header.pack(page.leaf, len(page.keys), page.next)]
+        parts.extend(self.__encode_key(key) for key in page.keys)
+        parts.append(struct.pack(f'>{len(page.items)}Q', *page.items))
+        return b''.join(parts).ljust(self.__page_size, b'\0')
+
+    def __decode_page(self, data: bytes) -> _Page:
+        leaf, count, next_leaf = self.page_header.unpack_from(data)
+        key_len = self.__key_len
+        start = self.page_header.size
+        keys = [self.__decode_key(data[start + i * key_len:start + (i + 1) * key_len]) for i in range(count)]
+        item_count = count if leaf else count + 1
+        items = list(struct.unpack_from(f'>{item_count}Q', data, start + count * key_len))
+        return _Page(bool(leaf), keys, items, next_leaf)
+
+    # pages and the header
+
+    def __read_page(self, page_number: int) -> _Page:
+        '''Get a page from the cache or read it from the file.'''
+        with self.__pages_lock:
+            page = self.__pages.get(page_number)
+            if page is not None:
+                self.__pages.move_to_end(page_number)
+                return page
+        page = self.__decode_page(os.pread(self.__fd, self.__page_size, page_number * self.__page_size))
+        self.__cache(page_number, page)
+        return page
+
+    def __cache(self, page_number: int, page: _Page) -> None:
+        with self.__pages_lock:
+            self.__pages[page_number] = page
+            self.__pages.move_to_end(page_number)
+            while len(self.__pages) > self.__cache_pages:
+                self.__pages.popitem(last=False)
+
+    def __write_page(self, page_number: int, page: _Page) -> None:
+        '''Write a changed page to the file and keep it in the cache.'''
+        if not self.__dirty:
+            # the tree is marked as dirty before its first page is changed
+            self.__dirty = True
+            self.__write_header()
+        os.pwrite(self.__fd, self.__encode_page(page), page_number * self.__page_size)
+        self.__cache(page_number, page)
+
+    def __new_page(self, page: _Page) -> int:
+        '''Write a page at the end of the file.\n
+        Returns: the number of the page.'''
+        page_number = self.__page_count
+        self.__page_count += 1
+        self.__write_page(page_number, page)
+        return page_number
+
+    def __write_header(self) -> None:
+        os.pwrite(self.__fd, self.header.pack(self.magic, self.__page_size, self.__key_len, self.__root,
+                                              self.__page_count, self.__size, self.__changes, self.__dirty), 0)
+
+    def __read_header(self) -> bool:
+        '''Read the header of the file.\n
+        Returns: False if the file isn't a tree with the pages of this index.'''
+        data = os.pread(self.__fd, self.header.size, 0)
+        if len(data) < self.header.size:
+            return False
+        magic, page_size, key_len, root, page_count, size, changes, dirty = self.header.unpack(data)
+        if (magic, page_size, key_len) != (self.magic, self.__page_size, self.__key_len):
+            return False
+        if os.fstat(self.__fd).st_size < page_count * self.__page_size:
+            return False
+        self.__root, self.__page_count, self.__size, self.__changes = root, page_count, size, changes
+        self.clean = not dirty
+        return True
+
+    def __commit(self) -> None:
+        '''Finish a change of the tree by writing the header that marks it as clean.'''
+        self.__changes += 1
+        self.__dirty = False
+        self.__write_header()
+
+    def __open(self) -> None:
+        if self.__fd is not None:
+            os.close(self.__fd)
+        self.__fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT)
+        stat = os.fstat(self.__fd)
+        self.__file_id = (stat.st_ino, stat.st_dev)
+        self.__pages.clear()
+
+    def __current_file_id(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_dev
+
+    # loading and persistence
+
+    def load(self) -> None:
+        '''Open the file of the tree, an empty tree is made if the file is missing or broken.\n
+        `clean` is False if the tree may not match its table.'''
+        self.__open()
+        file_size = os.fstat(self.__fd).st_size
+        if not self.__read_header():
+            self.__root, self.__page_count, self.__size = 1, 2, 0
+            self.__write_page(1, _Page(True, [], []))
+            self.__commit()
+            self.clean = file_size == 0
+
+    def refresh(self) -> None:
+        '''Catch up with the changes written by other processes.\n
+        Cached pages are dropped if the tree was changed.'''
+        if self.__current_file_id() != self.__file_id:
+            self.load()
+            return None
+        changes = self.__changes
+        self.__read_header()
+        if self.__changes != changes:
+            self.__pages.clear()
+        return None
+
+    def sync(self) -> None:
+        '''Force the changed pages to disk.'''
+        if self.__fd is None:
+            return
+        start = time.perf_counter() if self.metrics else 0.0
+        os.fsync(self.__fd)
+        if self.metrics:
+            self.metrics.count('index_flushes')
+            self.metrics.count('index_flush_seconds', time.perf_counter() - start)
+
+    def checkpoint(self) -> None:
+        '''Force the tree to disk, its pages are always written in place.'''
+        self.sync()
+
+    def close(self) -> None:
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        self.__pages.clear()
+
+    # lookups
+
+    def __find_leaf(self, key: int | str) -> tuple[list[tuple[int, _Page, int]], int, _Page]:
+        '''Descend from the root to the leaf that may have a key.\n
+        Returns: the internal pages on the way with the positions of the
+        children taken, and the number and the page of the leaf.'''
+        path = []
+        page_number = self.__root
+        page = self.__read_page(page_number)
+        while not page.leaf:
+            i = bisect_right(page.keys, key)
+            path.append((page_number, page, i))
+            page_number = page.items[i]
+            page = self.__read_page(page_number)
+        return path, page_number, page
+
+    def get(self, key: int | str, default: int | None = None) -> int | None:
+        _, _, leaf = self.__find_leaf(key)
+        i = bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            return leaf.items[i]
+        return default
+
+    def items(self) -> Iterator[tuple[int | str, int]]:
+        '''Iterate over the keys and values in the order of the keys by the linked leaves.'''
+        page = self.__read_page(self.__root)
+        while not page.leaf:
+            page = self.__read_page(page.items[0])
+        while True:
+            yield from zip(list(page.keys), list(page.items))
+            if not page.next:
+                return
+            page = self.__read_page(page.next)
+
+    def keys(self) -> Iterator[int | str]:
+        return (key for key, _ in self.items())
+
+    def values(self) -> Iterator[int]:
+        return (value for _, value in self.items())
+
+    # changes
+
+    def __set(self, key: int | str, value: int) -> None:
+        '''Insert a key or change its value and split the full pages on the way.'''
+        path, leaf_number, leaf = self.__find_leaf(key)
+        i = bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            leaf.items[i] = value
+            self.__write_page(leaf_number, leaf)
+            return
+        leaf.keys.insert(i, key)
+        leaf.items.insert(i, value)
+        self.__size += 1
+        if len(leaf.keys) <= self.__leaf_capacity:
+            self.__write_page(leaf_number, leaf)
+            return
+
+        # splitting the leaf and then the full internal pages up to the root
+        middle = len(leaf.keys) // 2
+        right = _Page(True, leaf.keys[middle:], leaf.items[middle:], leaf.next)
+        separator = right.keys[0]
+        right_number = self.__new_page(right)
+        leaf.keys, leaf.items, leaf.next = leaf.keys[:middle], leaf.items[:middle], right_number
+        self.__write_page(leaf_number, leaf)
+        while path:
+            page_number, page, i = path.pop()
+            page.keys.insert(i, separator)
+            page.items.insert(i + 1, right_number)
+            if len(page.keys) <= self.__node_capacity:
+                self.__write_page(page_number, page)
+                return
+            middle = len(page.keys) // 2
+            separator = page.keys[middle]
+            right_number = self.__new_page(_Page(False, page.keys[middle + 1:], page.items[middle + 1:]))
+            page.keys, page.items = page.keys[:middle], page.items[:middle + 1]
+            self.__write_page(page_number, page)
+        self.__root = self.__new_page(_Page(False, [separator], [self.__root, right_number]))
+
+    def set(self, key: int | str, value: int) -> None:
+        '''Set a value of a key.'''
+        self.__set(key, value)
+        self.__commit()
+
+    def set_many(self, items: list[tuple[int | str, int]]) -> None:
+        '''Set values of many keys, they are inserted in the order of the keys.'''
+        for key, value in sorted(items):
+            self.__set(key, value)
+        self.__commit()
+
+    def remove(self, key: int | str) -> int:
+        '''Remove a key.\n
+        Returns: the value of the key.'''
+        _, leaf_number, leaf = self.__find_leaf(key)
+        i = bisect_left(leaf.keys, key)
+        if i == len(leaf.keys) or leaf.keys[i] != key:
+            raise KeyError(key)
+        del leaf.keys[i]
+        value = leaf.items.pop(i)
+        self.__size -= 1
+        self.__write_page(leaf_number, leaf)
+        self.__commit()
+        return value
+
+    def rebuild(self, items: Iterable[tuple[int | str, int]]) -> None:
+        '''Replace all entries of the index with a compact tree built bottom-up.'''
+        entries = sorted(items)
+        tmp_path = self.file_path + '.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        try:
+            page_count = 1
+            # leaves are filled up, a level of pages is a list of their numbers and first keys
+            level: list[tuple[int, int | str | None]] = []
+            chunks = [entries[i:i + self.__leaf_capacity]
+                      for i in range(0, len(entries), self.__leaf_capacity)] or [[]]
+            for n, chunk in enumerate(chunks):
+                next_leaf = page_count + 1 if n + 1 < len(chunks) else 0
+                page = _Page(True, [key for key, _ in chunk], [value for _, value in chunk], next_leaf)
+                os.pwrite(fd, self.__encode_page(page), page_count * self.__page_size)
+                level.append((page_count, chunk[0][0] if chunk else None))
+                page_count += 1
+            while len(level) > 1:
+                fanout = self.__node_capacity + 1
+                upper = []
+                for i in range(0, len(level), fanout):
+                    children = level[i:i + fanout]
+                    page = _Page(False, [key for _, key in children[1:]], [number for number, _ in children])
+                    os.pwrite(fd, self.__encode_page(page), page_count * self.__page_size)
+                    upper.append((page_count, children[0][1]))
+                    page_count += 1
+                level = upper
+            os.pwrite(fd, self.header.pack(self.magic, self.__page_size, self.__key_len, level[0][0],
+                                           page_count, len(entries), self.__changes + 1, False), 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, self.file_path)
+        self.__open()
+        self.__read_header()
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import sys
+import threading
+from typing import Any, Hashable
+
+
+def size_of(obj: Any) -> int:
+    '''Estimate the memory taken by an object with the values of its attributes in bytes.'''
+    size = sys.getsizeof(obj)
+    attributes = getattr(obj, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes) + sum(sys.getsizeof(value) for value in attributes.values())
+    return size
+
+
+class LRUCache:
+    '''A cache of objects bounded by their estimated size in bytes.\n
+    The least recently used objects are evicted when the objects take more
+    than `max_bytes`, a cache with `max_bytes` of 0 keeps nothing. Hits and
+    misses of lookups are counted. The cache can be used by many threads.'''
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        # key -> object and its size, from the least to the most recently used
+        self.__items: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    def get(self, key: Hashable) -> Any | None:
+        '''Get an object by its key and mark it as recently used.\n
+        Returns: None if the object isn't cached.'''
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__items.move_to_end(key)
+            return item[0]
+
+    def put(self, key: Hashable, obj: Any) -> None:
+        '''Cache an object and evict the least recently used ones if the cache is full.'''
+        size = size_of(key) + size_of(obj)
+        if size > self.max_bytes:
+            self.invalidate(key)
+            return
+        with self.__lock:
+            old_item = self.__items.pop(key, None)
+            if old_item is not None:
+                self.bytes -= old_item[1]
+            self.__items[key] = (obj, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.__items.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def invalidate(self, key: Hashable) -> None:
+        '''Remove an object from the cache.'''
+        with self.__lock:
+            item = self.__items.pop(key, None)
+            if item is not None:
+                self.bytes -= item[1]
+
+    def clear(self) -> None:
+        '''Remove all objects from the cache.'''
+        with self.__lock:
+            self.__items.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        '''Get the counters of the cache.'''
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.__items),
+                'bytes': self.bytes, 'max_bytes': self.max_bytes}
@@ -0,0 +1,75 @@
+import json
+import os
+from typing import Any, BinaryIO
+
+
+def read_changes(file_path: str, offset: int = 0) -> tuple[list[tuple[int, str, Any]], int]:
+    '''Read change records of a change log starting at an offset.\n
+    Reading stops at an incomplete line that is still being written.\n
+    Returns: sequence numbers, operations and arguments of the changes and
+    the offset of the first unread line.'''
+    if not os.path.exists(file_path):
+        return [], 0
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    changes = []
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b'\n'):
+            break
+        entry = json.loads(line)
+        changes.append((entry['seq'], entry['op'], entry['args']))
+        offset += len(line)
+    return changes, offset
+
+
+class ChangeLog:
+    '''An append-only log of changes of a database for change data capture.\n
+    Every applied operation is a JSON line with its sequence number, its name
+    and its arguments, in the order of the operations. Writers of all processes
+    append to the same log while holding the lock of the database, so a writer
+    reads the lines appended by other processes before it appends its own.
+    The log is opened holding the lock too, since an incomplete last line is
+    cut off. The log is read by replicas with `read_changes`.'''
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.__file: BinaryIO = open(file_path, "ab")
+        self.__offset = 0
+        self.last_seq = 0
+        # the last change, a change replayed after a crash isn't written twice
+        self.__last: tuple[str, Any] | None = None
+        self.__catch_up()
+
+    def __catch_up(self) -> None:
+        '''Read the changes appended by other processes.\n
+        An incomplete line left by a crash is cut off.'''
+        if os.fstat(self.__file.fileno()).st_size == self.__offset:
+            return
+        changes, self.__offset = read_changes(self.file_path, self.__offset)
+        if changes:
+            self.last_seq, op, args = changes[-1]
+            self.__last = (op, args)
+        self.__file.truncate(self.__offset)
+
+    def append(self, op: str, args: Any, replayed: bool = False) -> None:
+        '''Write a change to the log.\n
+        A `replayed` change that is the same as the last one isn't written again.'''
+        self.__catch_up()
+        # arguments are compared in their JSON form
+        args = json.loads(json.dumps(args))
+        if replayed and self.__last == (op, args):
+            return
+        self.last_seq += 1
+        line = json.dumps({'seq': self.last_seq, 'op': op, 'args': args}).encode() + b'\n'
+        self.__file.write(line)
+        self.__file.flush()
+        self.__offset += len(line)
+        self.__last = (op, args)
+
+    def sync(self) -> None:
+        '''Force the log to disk.'''
+        os.fsync(self.__file.fileno())
+
+    def close(self) -> None:
+        self.__file.close()
@@ -0,0 +1,237 @@
+from datetime import datetime
+from decimal import Decimal
+import os
+from typing import Any, Callable, Iterable
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for analytics
+    np = None
+
+from storage import BinaryFormat, TextFormat, read_records
+
+# number of decimal places of decimals stored as scaled integers
+DECIMAL_PLACES = 2
+# functions of metrics of `Snapshot.aggregate`
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'mean', 'min', 'max')
+# parts of dates a column can be grouped by, as `<column>.<part>`
+DATE_PARTS = {'year': 'datetime64[Y]', 'month': 'datetime64[M]', 'day': 'datetime64[D]'}
+
+
+class TableColumns:
+    '''Columns of a table decoded into NumPy arrays.\n
+    Row i of every column is line i of the table. Strings and enums are
+    fixed-width bytes, decimals are int64 scaled by 10^DECIMAL_PLACES and
+    datetimes are datetime64[us]. Rows of removed records are masked out
+    by `live`. New records are read from the tail of the table by `refresh`,
+    overwritten records are read again by their line numbers.'''
+
+    def __init__(self, file_path: str, fmt: TextFormat | BinaryFormat) -> None:
+        self.file_path = file_path
+        self.__fmt = fmt
+        self.__fields = list(fmt.cls.model_fields.items())
+        self.columns: dict[str, np.ndarray] = {name: self.__make_column(field.annotation, [])
+                                               for name, field in self.__fields}
+        self.live = np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.live)
+
+    @staticmethod
+    def __make_column(annotation: type, values: list[Any]) -> np.ndarray:
+        '''Make a column of parsed values of a field.'''
+        if annotation is Decimal:
+            return np.array([int(value.scaleb(DECIMAL_PLACES)) for value in values], dtype=np.int64)
+        if annotation is datetime:
+            return np.array(values, dtype='datetime64[us]')
+        if annotation is int:
+            return np.array(values, dtype=np.int64)
+        return np.array([value.encode() for value in values], dtype=bytes)
+
+    @staticmethod
+    def __default(annotation: type) -> Any:
+        '''Get a value of a field for rows of removed records.'''
+        if annotation is Decimal:
+            return Decimal(0)
+        if annotation is datetime:
+            return datetime(1970, 1, 1)
+        if annotation is int:
+            return 0
+        return ''
+
+    def __decode(self, records: Iterable[bytes]) -> tuple[list[list[Any]], list[bool]]:
+        '''Parse records into values of the fields.\n
+        Returns: lists of values of every field and liveness of the records.'''
+        values: list[list[Any]] = [[] for _ in self.__fields]
+        live: list[bool] = []
+        for record in records:
+            raw = self.__fmt.split(record)
+            live.append(raw is not None)
+            for i, (_, field) in enumerate(self.__fields):
+                values[i].append(self.__default(field.annotation) if raw is None else self.__fmt.parse(i, raw[i]))
+        return values, live
+
+    def refresh(self, changed_lines: Iterable[int] = ()) -> None:
+        '''Read the records appended to the table and the overwritten ones.'''
+        record_size = self.__fmt.record_size
+        table_size = os.path.getsize(self.file_path) // record_size
+        if table_size < len(self):  # the table was rewritten
+            self.__init__(self.file_path, self.__fmt)
+        old_size = len(self)
+        lines = sorted(line for line in set(changed_lines) if line < old_size)
+        if lines:
+            with open(self.file_path, "rb") as f:
+                records = [os.pread(f.fileno(), record_size, line * record_size) for line in lines]
+            values, live = self.__decode(records)
+            self.live[lines] = live
+            for (name, field), field_values in zip(self.__fields, values):
+                self.__set_rows(name, lines, self.__make_column(field.annotation, field_values))
+        if table_size > old_size:
+            records = read_records(self.file_path, record_size, old_size * record_size)
+            values, live = self.__decode(records)
+            self.live = np.concatenate([self.live, np.array(live, dtype=bool)])
+            for (name, field), field_values in zip(self.__fields, values):
+                self.columns[name] = np.concatenate([self.columns[name],
+                                                     self.__make_column(field.annotation, field_values)])
+
+    def __set_rows(self, name: str, lines: list[int], values: np.ndarray) -> None:
+        '''Overwrite rows of a column, a bytes column is widened for longer values.'''
+        column = self.columns[name]
+        if column.dtype.kind == 'S' and values.dtype.itemsize > column.dtype.itemsize:
+            column = self.columns[name] = column.astype(values.dtype)
+        column[lines] = values
+
+
+def _join(keys: np.ndarray, other_keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''Match keys with unique keys of another table by a sorted lookup.\n
+    Returns: positions of the matched keys and of their matches in the other table.'''
+    order = np.argsort(other_keys, kind='stable')
+    sorted_keys = other_keys[order]
+    positions = np.searchsorted(sorted_keys, keys)
+    found = positions < len(sorted_keys)
+    found[found] = sorted_keys[positions[found]] == keys[found]
+    return np.flatnonzero(found), order[positions[found]]
+
+
+class Snapshot:
+    '''A columnar snapshot of the models, cars and sales tables for analytics.\n
+    Tables are decoded once and refreshed incrementally (see `TableColumns`),
+    aggregates are computed with vectorized NumPy operations. Requires numpy.'''
+
+    # table name -> table file name
+    files = {'models': 'models.txt', 'cars': 'cars.txt', 'sales': 'sales.txt'}
+    # fields of the tables that hold decimals
+    decimal_fields = {'price', 'cost'}
+
+    def __init__(self, root_directory_path: str, formats: dict[str, TextFormat | BinaryFormat]) -> None:
+        if np is None:
+            raise ImportError("numpy is required for columnar snapshots, install it with `pip install numpy`")
+        self.tables = {name: TableColumns(root_directory_path + "/" + file_name, formats[file_name])
+                       for name, file_name in self.files.items()}
+        self.refresh()
+
+    def refresh(self, changed_lines: dict[str, Iterable[int]] | None = None) -> None:
+        '''Read new and overwritten records, `changed_lines` maps table file names to overwritten lines.'''
+        changed_lines = changed_lines or {}
+        for name, table in self.tables.items():
+            table.refresh(changed_lines.get(self.files[name], ()))
+
+    def view(self, table_name: str) -> dict[str, np.ndarray]:
+        '''Get the columns of the live rows of a table joined with the tables it refers to.\n
+        Sales are joined with their cars by vin and cars with their models by
+        model id, rows without a match are left out.\n
+        Returns: column name -> column.'''
+        if table_name not in self.tables:
+            raise ValueError(f"Unknown table: {table_name}")
+        # sales refer to cars and cars refer to models
+        chain = ('sales', 'cars', 'models')
+        tables = chain[chain.index(table_name):]
+        live = self.tables[tables[0]].live
+        columns = {name: column[live] for name, column in self.tables[tables[0]].columns.items()}
+        for key, other_name, other_key in (('car_vin', 'cars', 'vin'), ('model', 'models', 'id')):
+            if other_name not in tables[1:]:
+                continue
+            other = self.tables[other_name]
+            other_columns = {name: column[other.live] for name, column in other.columns.items()}
+            rows, other_rows = _join(columns[key], other_columns[other_key])
+            columns = {name: column[rows] for name, column in columns.items()}
+            columns.update((name, column[other_rows]) for name, column in other_columns.items())
+        return columns
+
+    def aggregate(self, table_name: str, group_by: list[str],
+                  metrics: dict[str, tuple[str, str | Callable[[dict[str, np.ndarray]], np.ndarray] | None]]
+                  ) -> list[dict[str, Any]]:
+        '''Group the rows of a table view (see `view`) and compute metrics
+        of the groups (see `CarService.aggregate`).'''
+        columns = self.view(table_name)
+        for function, _ in metrics.values():
+            if function not in AGGREGATE_FUNCTIONS:
+                raise ValueError(f"Unknown aggregate function: {function}")
+        group_columns = [self.__group_column(columns, name) for name in group_by]
+        row_count = len(next(iter(columns.values())))
+        if not row_count:
+            return []
+
+        # numbering the groups by their keys
+        key_values = []
+        codes = []
+        for column in group_columns:
+            values, inverse = np.unique(column, return_inverse=True)
+            key_values.append(values)
+            codes.append(inverse.reshape(-1))
+        shape = [len(values) for values in key_values]
+        group_keys, groups = np.unique(np.ravel_multi_index(codes, shape) if codes else np.zeros(row_count, dtype=int),
+                                       return_inverse=True)
+        groups = groups.reshape(-1)
+        key_codes = np.unravel_index(group_keys, shape) if codes else ()
+        # rows sorted by groups, a group starts where its number changes
+        order = np.argsort(groups, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(groups[order]) != 0])
+        counts = np.diff(np.r_[starts, row_count])
+
+        results: list[dict[str, Any]] = [
+            {name: self.__to_python(name, values[group_codes[i]])
+             for name, values, group_codes in zip(group_by, key_values, key_codes)}
+            for i in range(len(group_keys))
+        ]
+        for metric_name, (function, column_name) in metrics.items():
+            if function == 'count':
+                values = counts
+            else:
+                column = column_name(columns) if callable(column_name) else self.__column(columns, column_name)
+                column = column[order]
+                if function == 'mean':
+                    values = np.add.reduceat(column, starts) / counts
+                else:
+                    reduce = {'sum': np.add, 'min': np.minimum, 'max': np.maximum}[function]
+                    values = reduce.reduceat(column, starts)
+            for result, value in zip(results, values):
+                result[metric_name] = self.__to_python(column_name, value, function)
+        return results
+
+    @staticmethod
+    def __column(columns: dict[str, np.ndarray], name: str) -> np.ndarray:
+        if name not in columns:
+            raise ValueError(f"Unknown column: {name}")
+        return columns[name]
+
+    def __group_column(self, columns: dict[str, np.ndarray], name: str) -> np.ndarray:
+        '''Get a column to group by, a date column can be truncated to a part, e.g. "sales_date.month".'''
+        column_name, _, part = name.partition('.')
+        column = self.__column(columns, column_name)
+        if not part:
+            return column
+        if part not in DATE_PARTS or column.dtype.kind != 'M':
+            raise ValueError(f"Unknown column: {name}")
+        return column.astype(DATE_PARTS[part])
+
+    def __to_python(self, column_name: Any, value: Any, function: str | None = None) -> Any:
+        '''Convert a NumPy value of a column back to a Python value.'''
+        decimal = isinstance(column_name, str) and column_name.partition('.')[0] in self.decimal_fields
+        if decimal and function != 'count':
+            if function == 'mean':
+                return float(value) / 10 ** DECIMAL_PLACES
+            return Decimal(int(value)).scaleb(-DECIMAL_PLACES)
+        if isinstance(value, bytes):
+            return value.decode()
+        return value.item() if isinstance(value, np.generic) else value
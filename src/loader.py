@@ -0,0 +1,21 @@
+import csv
+from typing import Iterator
+
+from pydantic import BaseModel
+
+
+def read_objects(file_path: str, cls: type[BaseModel]) -> Iterator[BaseModel]:
+    '''Read objects of a class from a CSV or a JSONL file one by one.\n
+    CSV files must have a header with the names of the fields, JSONL files
+    contain one JSON object per line. Values are validated by pydantic.'''
+    if file_path.endswith('.csv'):
+        with open(file_path, "r", newline='') as f:
+            for row in csv.DictReader(f):
+                yield cls.model_validate(row)
+    elif file_path.endswith('.jsonl'):
+        with open(file_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    yield cls.model_validate_json(line)
+    else:
+        raise ValueError(f"Unsupported file format: {file_path}")
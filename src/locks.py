@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
+from typing import Iterator
+
+
+class ReadWriteLock:
+    '''A readers-writer lock for the threads of a process that is also held
+    on a lock file with `fcntl.flock`, so that it works between processes.\n
+    Many threads and processes can read at once, a writer waits until they
+    are done and excludes everybody else. Waiting writers go before new
+    readers. A thread can take the lock again while it holds it, and a writer
+    can also take it for reading.'''
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.__condition = threading.Condition()
+        # number of threads reading and the thread writing now
+        self.__readers = 0
+        self.__writer: int | None = None
+        self.__write_depth = 0
+        self.__waiting_writers = 0
+        # read depth of the current thread
+        self.__local = threading.local()
+        # descriptor of the lock file, it's opened again in a forked process
+        # since a descriptor inherited from a parent shares its locks
+        self.__fd: int | None = None
+        self.__pid: int | None = None
+
+    def __lock_file(self, operation: int) -> None:
+        '''Lock or unlock the lock file.'''
+        if self.__pid != os.getpid():
+            self.__fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT)
+            self.__pid = os.getpid()
+        fcntl.flock(self.__fd, operation)
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        '''Hold the lock for reading.'''
+        me = threading.get_ident()
+        depth = getattr(self.__local, 'depth', 0)
+        if depth or self.__writer == me:  # if the thread holds the lock already
+            self.__local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.__local.depth = depth
+            return
+
+        with self.__condition:
+            while self.__writer is not None or self.__waiting_writers:
+                self.__condition.wait()
+            if not self.__readers:
+                self.__lock_file(fcntl.LOCK_SH)
+            self.__readers += 1
+        self.__local.depth = 1
+        try:
+            yield
+        finally:
+            self.__local.depth = 0
+            with self.__condition:
+                self.__readers -= 1
+                if not self.__readers:
+                    self.__lock_file(fcntl.LOCK_UN)
+                    self.__condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        '''Hold the lock for writing.'''
+        me = threading.get_ident()
+        if self.__writer == me:  # if the thread holds the lock already
+            self.__write_depth += 1
+            try:
+                yield
+            finally:
+                self.__write_depth -= 1
+            return
+        if getattr(self.__local, 'depth', 0):
+            raise RuntimeError("A lock held for reading can't be taken for writing")
+
+        with self.__condition:
+            self.__waiting_writers += 1
+            while self.__writer is not None or self.__readers:
+                self.__condition.wait()
+            self.__waiting_writers -= 1
+            self.__writer = me
+        try:
+            self.__lock_file(fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self.__lock_file(fcntl.LOCK_UN)
+        finally:
+            with self.__condition:
+                self.__writer = None
+                self.__condition.notify_all()
+
+    def close(self) -> None:
+        '''Close the lock file.'''
+        if self.__fd is not None and self.__pid == os.getpid():
+            os.close(self.__fd)
+        self.__fd = None
+        self.__pid = None
@@ -0,0 +1,92 @@
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable
+
+
+class Metrics:
+    '''Counters and latency histograms of a database.\n
+    Latencies of method calls are counted in histogram buckets with upper
+    bounds in seconds. Counters are named values that are only increased.
+    Metrics are exported as a dict by `stats` and in the Prometheus text
+    format by `prometheus`.'''
+
+    # upper bounds of latency buckets in seconds
+    buckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+    # counters with their descriptions
+    counters = {
+        'file_opens': "Files of tables opened.",
+        'bytes_read': "Bytes read from tables.",
+        'bytes_written': "Bytes written to tables.",
+        'seeks': "Random accesses to records of tables.",
+        'index_flushes': "Writes of index journals and index checkpoints.",
+        'index_flush_seconds': "Time spent writing index journals and checkpoints in seconds.",
+    }
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__values: dict[str, float] = dict.fromkeys(self.counters, 0)
+        # method -> number of calls in every bucket (the last one is +Inf) and total time
+        self.__histograms: dict[str, list[int]] = {}
+        self.__durations: dict[str, float] = {}
+
+    def count(self, name: str, value: float = 1) -> None:
+        '''Increase a counter.'''
+        with self.__lock:
+            self.__values[name] += value
+
+    def observe(self, method: str, seconds: float) -> None:
+        '''Count a call of a method that took some time.'''
+        bucket = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self.__lock:
+            histogram = self.__histograms.get(method)
+            if histogram is None:
+                histogram = self.__histograms[method] = [0] * (len(self.buckets) + 1)
+                self.__durations[method] = 0.0
+            histogram[bucket] += 1
+            self.__durations[method] += seconds
+
+    def timed(self, name: str, method: Callable) -> Callable:
+        '''Wrap a method to observe its calls.'''
+        @wraps(method)
+        def wrapper(*args, **kwargs) -> Any:
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start)
+        return wrapper
+
+    def stats(self) -> dict[str, Any]:
+        '''Get the counters and, for every method, the number of calls,
+        their total time and the numbers of calls by latency buckets.'''
+        with self.__lock:
+            methods = {
+                method: {
+                    'calls': sum(histogram),
+                    'seconds': self.__durations[method],
+                    'buckets': {str(bound): count for bound, count in zip([*self.buckets, '+Inf'], histogram)},
+                }
+                for method, histogram in self.__histograms.items()
+            }
+            return {'methods': methods, **self.__values}
+
+    def prometheus(self, prefix: str = 'bibip') -> str:
+        '''Dump the metrics in the Prometheus text format.'''
+        stats = self.stats()
+        lines = [
+            f"# HELP {prefix}_method_duration_seconds Latency of calls of CarService methods.",
+            f"# TYPE {prefix}_method_duration_seconds histogram",
+        ]
+        for method, histogram in sorted(stats['methods'].items()):
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f'{prefix}_method_duration_seconds_bucket{{method="{method}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_method_duration_seconds_sum{{method="{method}"}} {histogram["seconds"]}')
+            lines.append(f'{prefix}_method_duration_seconds_count{{method="{method}"}} {histogram["calls"]}')
+        for name, description in self.counters.items():
+            lines.append(f"# HELP {prefix}_{name}_total {description}")
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {stats[name]}")
+        return '\n'.join(lines) + '\n'
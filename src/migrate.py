@@ -0,0 +1,32 @@
+import argparse
+import os
+
+from bibip_car_service import CarService
+from storage import make_formats, read_records, read_settings, write_settings
+
+
+def migrate(source_path: str, target_path: str, storage_format: str, record_len: int = 500) -> None:
+    '''Convert a database directory to another storage format.\n
+    Every table is converted in one streaming pass, removed sales are
+    dropped. Indexes of the new database are built by a scan of its tables.'''
+    source_formats = make_formats(*(read_settings(source_path) or ('text', 500)))
+    target_formats = make_formats(storage_format, record_len)
+    os.makedirs(target_path, exist_ok=True)
+    for file_name, source_format in source_formats.items():
+        target_format = target_formats[file_name]
+        with open(target_path + "/" + file_name, "wb") as f:
+            for record in read_records(source_path + "/" + file_name, source_format.record_size):
+                if source_format.split(record) is not None:
+                    f.write(target_format.encode(source_format.decode(record)))
+    write_settings(target_path, storage_format, record_len)
+    CarService(target_path).close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a database directory to another storage format.')
+    parser.add_argument('source', help='directory of the database')
+    parser.add_argument('target', help='directory of the converted database')
+    parser.add_argument('--format', choices=['text', 'binary'], default='binary', help='new storage format')
+    parser.add_argument('--record-len', type=int, default=500, help='length of text records')
+    args = parser.parse_args()
+    migrate(args.source, args.target, args.format, args.record_len)
@@ -19,6 +19,15 @@ class DatabaseRecord:
             result += str(value) + ';'
         return DatabaseRecord.extend_str_to(result[:-1], len)
 
+    @staticmethod
+    def parse_field(field_type: type, value: str):
+        '''Convert a field of a record from a table to its type.'''
+        if field_type is datetime:
+            return datetime.fromisoformat(value)
+        if field_type is CarStatus:
+            return CAR_STATUSES[value]
+        return field_type(value)
+
 
 class CarStatus(StrEnum):
     available = "available"
@@ -27,6 +36,22 @@ class CarStatus(StrEnum):
     delivery = "delivery"
 
 
+# cached lookup of statuses by their values
+CAR_STATUSES: dict[str, CarStatus] = {status.value: status for status in CarStatus}
+
+
+def construct_trusted(cls: type[BaseModel], **values):
+    '''Make an object from values of the right types without validation.\n
+    It's what `BaseModel.model_construct` does without handling defaults and
+    aliases, which makes it about twice as fast.'''
+    obj = cls.__new__(cls)
+    object.__setattr__(obj, '__dict__', values)
+    object.__setattr__(obj, '__pydantic_fields_set__', set(values))
+    object.__setattr__(obj, '__pydantic_extra__', None)
+    object.__setattr__(obj, '__pydantic_private__', None)
+    return obj
+
+
 class Car(BaseModel):
     vin: str
     model: int
@@ -53,6 +78,19 @@ class Car(BaseModel):
             status=CarStatus(car[4])
         )
 
+    @classmethod
+    def make_trusted_object(cls, record: str):
+        '''Make a car object from a record written by the database without validation.'''
+        car = record.strip().split(';')
+        return construct_trusted(
+            cls,
+            vin=car[0],
+            model=int(car[1]),
+            price=Decimal(car[2]),
+            date_start=datetime.fromisoformat(car[3]),
+            status=CAR_STATUSES[car[4]]
+        )
+
 
 class Model(BaseModel):
     id: int
@@ -76,6 +114,17 @@ class Model(BaseModel):
             brand=model[2]
         )
 
+    @classmethod
+    def make_trusted_object(cls, record: str):
+        '''Make a model object from a record written by the database without validation.'''
+        model = record.strip().split(';')
+        return construct_trusted(
+            cls,
+            id=int(model[0]),
+            name=model[1],
+            brand=model[2]
+        )
+
 
 class Sale(BaseModel):
     sales_number: str
@@ -101,6 +150,18 @@ class Sale(BaseModel):
             cost=Decimal(sale[3])
         )
 
+    @classmethod
+    def make_trusted_object(cls, record: str):
+        '''Make a sale object from a record written by the database without validation.'''
+        sale = record.strip().split(';')
+        return construct_trusted(
+            cls,
+            sales_number=sale[0],
+            car_vin=sale[1],
+            sales_date=datetime.fromisoformat(sale[2]),
+            cost=Decimal(sale[3])
+        )
+
 
 class CarFullInfo(BaseModel):
     vin: str
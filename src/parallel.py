@@ -0,0 +1,106 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import fcntl
+import multiprocessing
+import os
+import pickle
+from typing import Any, Iterator
+
+from storage import BinaryFormat, TextFormat
+
+
+class RecordFilter:
+    '''Conditions of a query checked on raw records of a table (see `CarService.query`).\n
+    A filter is sent to the worker processes of a `ScanPool` when its
+    conditions can be pickled, predicates that are lambdas or closures
+    are checked in the calling process.'''
+
+    def __init__(self, fmt: TextFormat | BinaryFormat, conditions: list[tuple[int, Any]],
+                 fields: list[str] | None = None) -> None:
+        self.fmt = fmt
+        self.conditions = conditions
+        self.field_names = list(fmt.cls.model_fields)
+        self.fields = fields
+
+    def __call__(self, record: bytes) -> Any:
+        '''Make the result for a record: an object or a dict with the chosen fields.\n
+        Returns: None if the record doesn't match or is removed.'''
+        fmt = self.fmt
+        values = fmt.split(record)
+        if values is None:  # if it's a removed record
+            return None
+        # a field is converted to its type only when it's checked
+        for i, condition in self.conditions:
+            value = fmt.parse(i, values[i])
+            if not (condition(value) if callable(condition) else value == condition):
+                return None
+        if self.fields is None:
+            return fmt.decode(record)
+        return {name: fmt.parse(self.field_names.index(name), values[self.field_names.index(name)])
+                for name in self.fields}
+
+    def picklable(self) -> bool:
+        try:
+            pickle.dumps(self.conditions)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return False
+        return True
+
+
+def _scan_range(file_path: str, lock_path: str, filter_record: RecordFilter, start: int,
+                count: int) -> tuple[int, list[Any]]:
+    '''Filter the records of a range of lines of a table in a worker process.\n
+    The range is read holding the lock file of the database shared,
+    so that it isn't read while a writer changes the table.\n
+    Returns: number of read records and the results.'''
+    record_size = filter_record.fmt.record_size
+    with open(lock_path, "a") as lock, open(file_path, "rb") as f:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            chunk = os.pread(f.fileno(), count * record_size, start * record_size)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    results = []
+    for offset in range(0, len(chunk) - record_size + 1, record_size):
+        result = filter_record(chunk[offset:offset + record_size])
+        if result is not None:
+            results.append(result)
+    return len(chunk) // record_size, results
+
+
+class ScanPool:
+    '''A long-lived pool of worker processes that scan ranges of tables.\n
+    Workers are forked by a fork server, a clean single-threaded process,
+    so the pool can be used from any thread. A scan is split into ranges
+    of about 1 MB that are filtered by the workers, at most two ranges per
+    worker are in flight, and their results are yielded in the order of the
+    table, so a scan of any table takes little memory.'''
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.__pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'))
+
+    def scan(self, file_path: str, lock_path: str, filter_record: RecordFilter) -> Iterator[tuple[int, list[Any]]]:
+        '''Scan a table, `filter_record` must be picklable.\n
+        The size of the table is checked before every range is sent,
+        so records appended during the scan are read too.\n
+        Returns: numbers of read records and results of the ranges in the order of the table.'''
+        record_size = filter_record.fmt.record_size
+        range_len = max(1, (1 << 20) // record_size)
+        in_flight: deque[Future] = deque()
+        start = 0
+        try:
+            while True:
+                while len(in_flight) < self.workers * 2 and start < os.path.getsize(file_path) // record_size:
+                    in_flight.append(self.__pool.submit(_scan_range, file_path, lock_path, filter_record,
+                                                        start, range_len))
+                    start += range_len
+                if not in_flight:
+                    return
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def close(self) -> None:
+        self.__pool.shutdown(cancel_futures=True)
@@ -0,0 +1,110 @@
+from datetime import datetime
+from decimal import Decimal
+import os
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+from bibip_car_service import CarService
+from cdc import read_changes
+from models import Car, CarFullInfo, CarStatus, Model, ModelSaleStats, Sale
+
+
+class ReadReplicaCarService:
+    '''A read-only copy of a `CarService` database kept current by its change log.\n
+    The primary database must be opened with `cdc` on. The replica is a
+    database of its own in another directory, with its own tables, indexes and
+    caches, and applies the new operations of the change log of the primary
+    (see `CarService.apply_change`) before every read. The sequence number and
+    the offset of the last applied operation are saved in replica.txt, so a
+    reopened replica goes on from there; operations applied again after a
+    crash don't change it. One process follows the log of a replica directory.'''
+
+    def __init__(self, primary_directory_path: str, root_directory_path: str, **options: Any) -> None:
+        '''Open a replica in a directory, `options` are passed to its `CarService`.'''
+        self.log_path = primary_directory_path + "/cdc.txt"
+        self.root_directory_path = root_directory_path
+        self.service = CarService(root_directory_path, **options)
+        self.__state_path = root_directory_path + "/replica.txt"
+        self.__seq, self.__offset = 0, 0
+        if os.path.exists(self.__state_path):
+            with open(self.__state_path, "r") as f:
+                seq, offset = f.read().split(';')
+            self.__seq, self.__offset = int(seq), int(offset)
+        self.__lock = threading.Lock()
+        self.catch_up()
+
+    @property
+    def applied_seq(self) -> int:
+        '''Sequence number of the last operation applied to the replica.'''
+        return self.__seq
+
+    def catch_up(self) -> int:
+        '''Apply the operations added to the change log since the last call.\n
+        Returns: number of applied operations.'''
+        with self.__lock:
+            log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+            if log_size == self.__offset:
+                return 0
+            if log_size < self.__offset:
+                raise ValueError(f"Change log {self.log_path} was truncated, the replica must be made again")
+            changes, offset = read_changes(self.log_path, self.__offset)
+            applied = 0
+            for seq, op, args in changes:
+                if seq <= self.__seq:
+                    continue
+                self.service.apply_change(op, args)
+                self.__seq = seq
+                applied += 1
+            self.__offset = offset
+            self.__save_state()
+            return applied
+
+    def __save_state(self) -> None:
+        '''Save the position in the change log replacing the file at once.'''
+        with open(self.__state_path + ".tmp", "w") as f:
+            f.write(f"{self.__seq};{self.__offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.__state_path + ".tmp", self.__state_path)
+
+    def __read(self, method: Callable[..., Any], *args: Any) -> Any:
+        self.catch_up()
+        return method(*args)
+
+    def close(self) -> None:
+        self.service.close()
+
+    def __enter__(self) -> 'ReadReplicaCarService':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def cache_stats(self) -> dict[str, int]:
+        return self.service.cache_stats()
+
+    def query(self, table_name: str, where: dict[str, Any] | None = None,
+              fields: list[str] | None = None) -> Iterator[Model | Car | Sale | dict[str, Any]]:
+        return self.__read(self.service.query, table_name, where, fields)
+
+    def get_cars(self, status: CarStatus, limit: int | None = None, after: str | None = None) -> list[Car]:
+        return self.__read(self.service.get_cars, status, limit, after)
+
+    def get_car_info(self, vin: str) -> CarFullInfo | None:
+        return self.__read(self.service.get_car_info, vin)
+
+    def get_car_info_many(self, vins: Iterable[str]) -> list[CarFullInfo | None]:
+        return self.__read(self.service.get_car_info_many, vins)
+
+    def get_sales(self, start: datetime, end: datetime) -> list[Sale]:
+        return self.__read(self.service.get_sales, start, end)
+
+    def revenue(self, start: datetime, end: datetime) -> Decimal:
+        return self.__read(self.service.revenue, start, end)
+
+    def aggregate(self, group_by: list[str], metrics: dict[str, tuple[str, Any]],
+                  table: str = 'sales') -> list[dict[str, Any]]:
+        return self.__read(self.service.aggregate, group_by, metrics, table)
+
+    def top_models_by_sales(self, k: int = 3) -> list[ModelSaleStats]:
+        return self.__read(self.service.top_models_by_sales, k)
@@ -0,0 +1,284 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+import heapq
+import os
+import threading
+from typing import Any, Callable, Iterable, Iterator
+import zlib
+
+from bibip_car_service import CarService
+from loader import read_objects
+from locks import ReadWriteLock
+from models import Car, CarFullInfo, CarStatus, Model, ModelSaleStats, Sale
+from table_index import TableIndex
+
+
+def shard_of(vin: str, shard_count: int) -> int:
+    '''Get the shard of a vin by a hash that is the same in every process.'''
+    return zlib.crc32(vin.encode()) % shard_count
+
+
+class ShardedCarService:
+    '''A `CarService` with cars and sales split into shards by vin.\n
+    Every shard is a `CarService` database in a subdirectory `shard_<n>`,
+    so it has its own tables, indexes, write-ahead log and locks. A car and
+    its sale are kept in the shard of the hash of the vin, so operations
+    with one car touch only its shard. Models are small and are copied to
+    every shard, so that shards join cars with their models locally. Scans
+    fan out to all shards in a thread pool.\n
+    A car keeps its shard when its vin is updated; the new vin is routed to
+    the shard by an entry of the routes index (routes_index.txt) if its hash
+    points to another shard.'''
+
+    def __init__(self, root_directory_path: str, shards: int = 4, **options: Any) -> None:
+        '''Open a sharded database in a directory.\n
+        The number of `shards` is saved in shards.txt when the database is
+        created and must match it later. `options` are passed to the
+        `CarService` of every shard.'''
+        self.root_directory_path = root_directory_path
+        settings_path = root_directory_path + "/shards.txt"
+        if os.path.exists(settings_path):
+            with open(settings_path, "r") as f:
+                saved_shards = int(f.read())
+            if saved_shards != shards:
+                raise ValueError(f"Database has {saved_shards} shards")
+        else:
+            with open(settings_path, "w") as f:
+                f.write(str(shards))
+        self.shards: list[CarService] = []
+        for n in range(shards):
+            os.makedirs(f"{root_directory_path}/shard_{n}", exist_ok=True)
+            self.shards.append(CarService(f"{root_directory_path}/shard_{n}", **options))
+        self.__executor = ThreadPoolExecutor(shards, thread_name_prefix='car-shard')
+        # updates of vins are serialized between the processes using the database
+        self.__lock = ReadWriteLock(root_directory_path + "/lock.txt")
+        # vin -> shard for updated vins whose hash points to another shard
+        self.__routes = TableIndex(root_directory_path + "/routes_index.txt", str, 30)
+        self.__routes_lock = threading.Lock()
+        with self.__lock.write():
+            self.__routes.load()
+
+    def __shard_number(self, vin: str) -> int:
+        with self.__routes_lock:
+            shard_number = self.__routes.get(vin)
+        return shard_of(vin, len(self.shards)) if shard_number is None else shard_number
+
+    def __shard(self, vin: str) -> CarService:
+        return self.shards[self.__shard_number(vin)]
+
+    def __refresh_routes(self) -> bool:
+        '''Read the routes added by other processes.\n
+        Returns: True if there were new routes.'''
+        with self.__lock.read(), self.__routes_lock:
+            changes = self.__routes.refresh()
+        return changes is None or bool(changes)
+
+    @contextmanager
+    def __routing(self) -> Iterator[None]:
+        '''Hold the lock of the database for reading with the routes up to date,
+        so that writes are routed to the shards of the cars and no vin is
+        moved by another process while they're written.'''
+        with self.__lock.read():
+            with self.__routes_lock:
+                self.__routes.refresh()
+            yield
+
+    @staticmethod
+    def __has_car(shard: CarService, vin: str) -> bool:
+        return next(shard.query('cars', {'vin': vin}, ['vin']), None) is not None
+
+    def __routed(self, vin: str, method: Callable[[CarService], Any]) -> Any:
+        '''Call a method of the shard of a vin.\n
+        If nothing is found, the routes are refreshed and the call is
+        repeated in case the vin was moved by another process.'''
+        shard_number = self.__shard_number(vin)
+        result = method(self.shards[shard_number])
+        if result is None and self.__refresh_routes() and self.__shard_number(vin) != shard_number:
+            result = method(self.__shard(vin))
+        return result
+
+    def __fan_out(self, method: Callable[[CarService], Any]) -> list[Any]:
+        '''Call a method of every shard in parallel.\n
+        Returns: the results in the order of the shards.'''
+        return list(self.__executor.map(method, self.shards))
+
+    def __split(self, objects: Iterable[Any], key: Callable[[Any], str]) -> list[list[Any]]:
+        '''Split objects between the shards of their vins.'''
+        parts: list[list[Any]] = [[] for _ in self.shards]
+        for obj in objects:
+            parts[self.__shard_number(key(obj))].append(obj)
+        return parts
+
+    def close(self) -> None:
+        '''Close the shards and shut the thread pool down.'''
+        self.__fan_out(CarService.close)
+        self.__routes.close()
+        self.__lock.close()
+        self.__executor.shutdown()
+
+    def checkpoint(self) -> None:
+        self.__fan_out(CarService.checkpoint)
+        with self.__lock.write():
+            self.__routes.checkpoint()
+
+    def sync(self) -> None:
+        self.__fan_out(CarService.sync)
+        self.__routes.sync()
+
+    def cache_stats(self) -> dict[str, int]:
+        '''Get the counters of the object caches of all shards summed up.'''
+        stats: dict[str, int] = {}
+        for shard_stats in self.__fan_out(CarService.cache_stats):
+            for name, value in shard_stats.items():
+                stats[name] = stats.get(name, 0) + value
+        return stats
+
+    def add_model(self, model: Model) -> Model:
+        self.__fan_out(lambda shard: shard.add_model(model))
+        return model
+
+    def add_models(self, models: Iterable[Model]) -> int:
+        models = list(models)
+        return self.__fan_out(lambda shard: shard.add_models(models))[0]
+
+    def add_car(self, car: Car) -> Car:
+        with self.__routing():
+            return self.__shard(car.vin).add_car(car)
+
+    def add_cars(self, cars: Iterable[Car]) -> int:
+        with self.__routing():
+            parts = self.__split(cars, lambda car: car.vin)
+            return sum(self.__executor.map(CarService.add_cars, self.shards, parts))
+
+    def sell_car(self, sale: Sale) -> Car | None:
+        '''Save a sale in the shard of its car.\n
+        Returns: None without saving the sale if there's no such car.'''
+        with self.__routing():
+            shard = self.__shard(sale.car_vin)
+            if not self.__has_car(shard, sale.car_vin):
+                return None
+            return shard.sell_car(sale)
+
+    def sell_cars(self, sales: Iterable[Sale]) -> int:
+        '''Save many sales in the shards of their cars, sales of unknown cars are skipped.\n
+        Returns: number of saved sales.'''
+        def sell(shard: CarService, sales: list[Sale]) -> int:
+            return shard.sell_cars(sale for sale in sales if self.__has_car(shard, sale.car_vin))
+
+        with self.__routing():
+            parts = self.__split(sales, lambda sale: sale.car_vin)
+            return sum(self.__executor.map(sell, self.shards, parts))
+
+    def load_file(self, file_path: str, table_name: str) -> int:
+        '''Load rows of a CSV or a JSONL file into a table (see `CarService.load_file`).'''
+        loaders = {
+            'models': (self.add_models, Model),
+            'cars': (self.add_cars, Car),
+            'sales': (self.sell_cars, Sale),
+        }
+        if table_name not in loaders:
+            raise ValueError(f"Unknown table: {table_name}")
+        add, cls = loaders[table_name]
+        return add(read_objects(file_path, cls))
+
+    def query(self, table_name: str, where: dict[str, Any] | None = None,
+              fields: list[str] | None = None) -> Iterator[Model | Car | Sale | dict[str, Any]]:
+        '''Find records of a table that match all conditions (see `CarService.query`).\n
+        Models are queried in the first shard, cars and sales with an equality
+        condition on vin in its shard, other queries in all shards at once.'''
+        where = where or {}
+        if table_name == 'models':
+            return self.shards[0].query(table_name, where, fields)
+        key_field = {'cars': 'vin', 'sales': 'car_vin'}.get(table_name)
+        if key_field in where and not callable(where[key_field]):
+            return self.__shard(where[key_field]).query(table_name, where, fields)
+        parts = self.__fan_out(lambda shard: list(shard.query(table_name, where, fields)))
+        return (obj for part in parts for obj in part)
+
+    def get_cars(self, status: CarStatus, limit: int | None = None, after: str | None = None) -> list[Car]:
+        '''Get the cars with a status (see `CarService.get_cars`).\n
+        Cars are ordered by shards and by the order of the table in a shard.'''
+        if limit is None and after is None:
+            return [car for cars in self.__fan_out(lambda shard: shard.get_cars(status)) for car in cars]
+        start = 0 if after is None else self.__shard_number(after)
+        cars: list[Car] = []
+        for shard_number in range(start, len(self.shards)):
+            count = None if limit is None else limit - len(cars)
+            if count == 0:
+                break
+            cars.extend(self.shards[shard_number].get_cars(status, count, after if shard_number == start else None))
+        return cars
+
+    def get_car_info(self, vin: str) -> CarFullInfo | None:
+        return self.__routed(vin, lambda shard: shard.get_car_info(vin))
+
+    def get_car_info_many(self, vins: Iterable[str]) -> list[CarFullInfo | None]:
+        '''Get detailed information about many cars with one call per shard.'''
+        vins = list(vins)
+        parts = self.__split(enumerate(vins), lambda item: item[1])
+        infos: list[CarFullInfo | None] = [None] * len(vins)
+        results = self.__executor.map(lambda shard, part: shard.get_car_info_many([vin for _, vin in part]),
+                                      self.shards, parts)
+        for part, part_infos in zip(parts, results):
+            for (i, _), info in zip(part, part_infos):
+                infos[i] = info
+        return infos
+
+    def get_sales(self, start: datetime, end: datetime) -> list[Sale]:
+        '''Get the sales made from `start` up to but not including `end` ordered by date.'''
+        parts = self.__fan_out(lambda shard: shard.get_sales(start, end))
+        return list(heapq.merge(*parts, key=lambda sale: sale.sales_date))
+
+    def revenue(self, start: datetime, end: datetime) -> Decimal:
+        return sum(self.__fan_out(lambda shard: shard.revenue(start, end)), Decimal(0))
+
+    def update_vin(self, vin: str, new_vin: str) -> Car | None:
+        '''Update a vin number.\n
+        The car stays in its shard, the new vin is routed to it before the
+        car is updated, so that it's found even if the update is replayed
+        from the write-ahead log of the shard after a crash.'''
+        with self.__lock.write():
+            with self.__routes_lock:
+                self.__routes.refresh()
+            shard_number = self.__shard_number(vin)
+            moved = shard_of(new_vin, len(self.shards)) != shard_number
+            if moved:
+                with self.__routes_lock:
+                    self.__routes.set(new_vin, shard_number)
+            car = self.shards[shard_number].update_vin(vin, new_vin)
+            with self.__routes_lock:
+                if car is None and moved:
+                    self.__routes.remove(new_vin)
+                elif car is not None and vin in self.__routes:
+                    self.__routes.remove(vin)
+            return car
+
+    def revert_sale(self, sales_number: str) -> Car | None:
+        '''Revert a sale, the vin of the car is the second part of the sales number.'''
+        vin = sales_number.split('#')[1]
+        with self.__routing():
+            return self.__shard(vin).revert_sale(sales_number)
+
+    def compact_sales(self) -> None:
+        self.__fan_out(CarService.compact_sales)
+
+    def top_models_by_sales(self, k: int = 3) -> list[ModelSaleStats]:
+        '''Find top k models by amount of sales in all shards.\n
+        The sales counters of the shards are summed up by model ids, models
+        with the same amount of sales are ordered by their first sales in all
+        shards. Names are taken from the first shard.'''
+        totals: dict[int, tuple[int, int]] = {}
+        for shard_counters in self.__fan_out(CarService.model_sales):
+            for model_id, (count, seq) in shard_counters.items():
+                total, first_seq = totals.get(model_id, (0, seq))
+                totals[model_id] = (total + count, min(first_seq, seq))
+        top_models = heapq.nsmallest(k, totals.items(), key=lambda item: (-item[1][0], item[1][1]))
+        model_sale_stats: list[ModelSaleStats] = []
+        for model_id, (count, _) in top_models:
+            model = next(self.shards[0].query('models', {'id': model_id}), None)
+            if model:
+                model_sale_stats.append(ModelSaleStats(car_model_name=model.name, brand=model.brand,
+                                                       sales_number=count))
+        return model_sale_stats
@@ -0,0 +1,199 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from enum import StrEnum
+import os
+import struct
+from typing import Any, Callable, Iterator
+
+from pydantic import BaseModel
+
+from models import Car, Model, Sale, DatabaseRecord as db, construct_trusted
+
+
+class TextFormat:
+    '''Records of a table as `;`-joined text padded to a fixed length.\n
+    Raw fields of a record are strings.'''
+
+    def __init__(self, cls: type[BaseModel], record_len: int = 500) -> None:
+        self.cls = cls
+        self.record_len = record_len
+        self.__line_sep = os.linesep.encode()
+        # size of a record with a line separator in bytes
+        self.record_size = record_len + len(self.__line_sep)
+        self.__field_types = [field.annotation for field in cls.model_fields.values()]
+
+    def encode(self, obj: BaseModel) -> bytes:
+        '''Make a record from an object.'''
+        record = obj.make_record(self.record_len).rstrip().encode()
+        if len(record) > self.record_len:
+            raise ValueError(f"Record is longer than {self.record_len} bytes: {record!r}")
+        return record.ljust(self.record_len) + self.__line_sep
+
+    def tombstone(self) -> bytes:
+        '''Make a record of a removed object.'''
+        return b' ' * self.record_len + self.__line_sep
+
+    def split(self, record: bytes) -> list[Any] | None:
+        '''Split a record into raw fields.\n
+        Returns: None if the record is removed.'''
+        text = record.decode().rstrip()
+        return text.split(';') if text else None
+
+    def parse(self, i: int, value: Any) -> Any:
+        '''Convert a raw field to the type of the i-th field of the object.'''
+        return db.parse_field(self.__field_types[i], value)
+
+    def decode(self, record: bytes) -> BaseModel:
+        '''Make an object from a record without validation.'''
+        return self.cls.make_trusted_object(record.decode())
+
+
+class BinaryFormat:
+    '''Records of a table packed with a fixed struct layout.\n
+    Strings are stored as fixed-width UTF-8 bytes, decimals as int64 scaled
+    by 10^decimal_places, datetimes as int64 microseconds since the epoch and
+    enums as uint8 codes. Every record starts with a flag byte that is zero
+    for removed records. Raw fields of a record are strings for strings and
+    enums and integers for numbers and datetimes.'''
+
+    decimal_places = 2
+    # widths of string fields in bytes
+    string_widths: dict[type[BaseModel], dict[str, int]] = {
+        Model: {'name': 64, 'brand': 32},
+        Car: {'vin': 17},
+        Sale: {'sales_number': 32, 'car_vin': 17},
+    }
+    __epoch = datetime(1970, 1, 1)
+
+    def __init__(self, cls: type[BaseModel]) -> None:
+        self.cls = cls
+        self.__fields = list(cls.model_fields.items())
+        # enum field index -> members of the enum by codes
+        self.__enum_members: dict[int, list[StrEnum]] = {}
+        layout = '<?'
+        for i, (name, field) in enumerate(self.__fields):
+            if field.annotation is str:
+                layout += f'{self.string_widths[cls][name]}s'
+            elif issubclass(field.annotation, StrEnum):
+                self.__enum_members[i] = list(field.annotation)
+                layout += 'B'
+            elif field.annotation is int:
+                layout += 'i'
+            else:  # decimals and datetimes
+                layout += 'q'
+        self.__struct = struct.Struct(layout)
+        self.record_size = self.__struct.size
+        # converters of unpacked values to the types of the fields
+        self.__decoders = [self.__make_decoder(i, field.annotation) for i, (_, field) in enumerate(self.__fields)]
+
+    def __make_decoder(self, i: int, field_type: type) -> Callable[[Any], Any]:
+        '''Make a converter of an unpacked value of the i-th field to its type.'''
+        if field_type is str:
+            return lambda value: value.rstrip(b'\0').decode()
+        if i in self.__enum_members:
+            return self.__enum_members[i].__getitem__
+        if field_type is Decimal:
+            return lambda value: Decimal(value).scaleb(-self.decimal_places)
+        if field_type is datetime:
+            return lambda value: self.__epoch + timedelta(microseconds=value)
+        return lambda value: value
+
+    def __reduce__(self) -> tuple[type, tuple[type[BaseModel]]]:
+        # converters are lambdas, so a format is sent to other processes as its class and made again
+        return BinaryFormat, (self.cls,)
+
+    def encode(self, obj: BaseModel) -> bytes:
+        '''Make a record from an object.'''
+        values: list[Any] = [True]
+        for i, (name, field) in enumerate(self.__fields):
+            value = getattr(obj, name)
+            if field.annotation is str:
+                data = value.encode()
+                if len(data) > self.string_widths[self.cls][name]:
+                    raise ValueError(f"{name} is too long for a binary record: {value!r}")
+                values.append(data)
+            elif i in self.__enum_members:
+                values.append(self.__enum_members[i].index(value))
+            elif field.annotation is Decimal:
+                scaled = value.scaleb(self.decimal_places)
+                if scaled != scaled.to_integral_value():
+                    raise ValueError(f"{name} has more than {self.decimal_places} decimal places: {value}")
+                values.append(int(scaled))
+            elif field.annotation is datetime:
+                values.append((value - self.__epoch) // timedelta(microseconds=1))
+            else:
+                values.append(value)
+        return self.__struct.pack(*values)
+
+    def tombstone(self) -> bytes:
+        '''Make a record of a removed object.'''
+        return bytes(self.record_size)
+
+    def split(self, record: bytes) -> list[Any] | None:
+        '''Split a record into raw fields.\n
+        Returns: None if the record is removed.'''
+        flag, *values = self.__struct.unpack(record)
+        if not flag:
+            return None
+        for i, (_, field) in enumerate(self.__fields):
+            if field.annotation is str:
+                values[i] = values[i].rstrip(b'\0').decode()
+            elif i in self.__enum_members:
+                values[i] = self.__enum_members[i][values[i]].value
+        return values
+
+    def parse(self, i: int, value: Any) -> Any:
+        '''Convert a raw field to the type of the i-th field of the object.'''
+        field_type = self.__fields[i][1].annotation
+        if field_type is Decimal:
+            return Decimal(value).scaleb(-self.decimal_places)
+        if field_type is datetime:
+            return self.__epoch + timedelta(microseconds=value)
+        if i in self.__enum_members:
+            return field_type._value2member_map_[value]
+        return value
+
+    def decode(self, record: bytes) -> BaseModel:
+        '''Make an object from a record without validation.'''
+        _, *values = self.__struct.unpack(record)
+        return construct_trusted(self.cls, **{name: decoder(value) for (name, _), decoder, value
+                                              in zip(self.__fields, self.__decoders, values)})
+
+
+def read_records(file_path: str, record_size: int, offset: int = 0) -> Iterator[bytes]:
+    '''Read fixed-size records of a table file sequentially in big chunks starting at an offset.'''
+    # number of records read at once
+    chunk_len = max(1, (1 << 20) // record_size)
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        while chunk := f.read(record_size * chunk_len):
+            for offset in range(0, len(chunk) - record_size + 1, record_size):
+                yield chunk[offset:offset + record_size]
+
+
+def make_formats(storage_format: str, record_len: int) -> dict[str, TextFormat | BinaryFormat]:
+    '''Make formats of all tables.\n
+    Returns: table file name -> format of its records.'''
+    tables = {'models.txt': Model, 'cars.txt': Car, 'sales.txt': Sale}
+    if storage_format == 'text':
+        return {file_name: TextFormat(cls, record_len) for file_name, cls in tables.items()}
+    if storage_format == 'binary':
+        return {file_name: BinaryFormat(cls) for file_name, cls in tables.items()}
+    raise ValueError(f"Unknown storage format: {storage_format}")
+
+
+def read_settings(root_directory_path: str) -> tuple[str, int] | None:
+    '''Read the storage format and the record length of a database directory.\n
+    Returns: None if they were never saved.'''
+    path = root_directory_path + "/storage.txt"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        storage_format, record_len = f.read().strip().split(';')
+    return storage_format, int(record_len)
+
+
+def write_settings(root_directory_path: str, storage_format: str, record_len: int) -> None:
+    '''Save the storage format and the record length of a database directory.'''
+    with open(root_directory_path + "/storage.txt", "w") as f:
+        f.write(db.make_record(0, storage_format, record_len))
@@ -0,0 +1,199 @@
+import os
+import time
+from typing import Any, Iterable, Iterator, TextIO
+
+from sortedcontainers import SortedDict
+
+from metrics import Metrics
+from models import DatabaseRecord as db
+
+
+class TableIndex:
+    '''An in-memory index of a table that is persisted on disk.\n
+    The index is stored as a sorted checkpoint file and an append-only journal
+    with the changes made since the last checkpoint. Only changed entries are
+    written on every update; the checkpoint file is rewritten when the journal
+    grows as large as the checkpoint or on demand. Changes made by other
+    processes are applied by `refresh` without reading the whole index again.'''
+
+    # the journal is never checkpointed while it is smaller than this
+    min_journal_size = 1000
+
+    def __init__(self, file_path: str, key_type: type, record_len: int, value_type: type = int,
+                 data: Any = None) -> None:
+        self.file_path = file_path
+        self.journal_path = file_path.removesuffix('.txt') + '_journal.txt'
+        self.__key_type = key_type
+        self.__value_type = value_type
+        self.__record_len = record_len
+        # sorted mapping of the entries, a SortedDict unless another one is given
+        self.__data = SortedDict() if data is None else data
+        # long-lived handle of the journal file
+        self.__journal: TextIO | None = None
+        # number of entries in the checkpoint and the journal files
+        self.__checkpoint_size = 0
+        self.__journal_size = 0
+        # identity of the checkpoint file and the size of the journal seen by this process
+        self.__checkpoint_id: tuple[int, int, int] | None = None
+        self.__journal_offset = 0
+        # flushes of the journal and checkpoints are counted when metrics are set
+        self.metrics: Metrics | None = None
+
+    def __getitem__(self, key: int | str) -> int | str:
+        return self.__data[key]
+
+    def __contains__(self, key: int | str) -> bool:
+        return key in self.__data
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def __iter__(self) -> Iterator[int | str]:
+        return iter(self.__data)
+
+    def get(self, key: int | str, default: int | str | None = None) -> int | str | None:
+        return self.__data.get(key, default)
+
+    def items(self):
+        return self.__data.items()
+
+    def keys(self):
+        return self.__data.keys()
+
+    def values(self):
+        return self.__data.values()
+
+    def __parse(self, text: str) -> Iterator[tuple[int | str, int | str | None]]:
+        '''Parse index entries of a checkpoint or a journal file.\n
+        An entry without a value marks a removed key.'''
+        for line in text.splitlines():
+            if len(line) < self.__record_len:  # an incomplete entry left by a crash
+                break
+            key, value = line.rstrip().rsplit(';', 1)
+            yield self.__key_type(key), self.__value_type(value) if value else None
+
+    def __read_file(self, path: str, offset: int = 0) -> tuple[str, int]:
+        '''Read a checkpoint or a journal file starting at an offset.\n
+        Returns: the text and the size of the file.'''
+        if not os.path.exists(path):
+            return '', 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        return data.decode(), offset + len(data)
+
+    @staticmethod
+    def __file_id(path: str) -> tuple[int, int, int] | None:
+        '''Identify a version of a file by its inode, modification time and size.'''
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def __apply_journal(self, entries: Iterable[tuple[int | str, int | str | None]]
+                        ) -> list[tuple[int | str, int | str | None, int | str | None]]:
+        '''Apply journal entries to the index.\n
+        Returns: changed keys with their old and new values.'''
+        changes = []
+        for key, value in entries:
+            self.__journal_size += 1
+            old_value = self.__data.pop(key, None) if value is None else self.__data.get(key)
+            if value is not None:
+                self.__data[key] = value
+            changes.append((key, old_value, value))
+        return changes
+
+    def load(self) -> None:
+        '''Load the checkpoint file and apply the journal on top of it.'''
+        self.__checkpoint_id = self.__file_id(self.file_path)
+        self.__data.clear()
+        self.__data.update(self.__parse(self.__read_file(self.file_path)[0]))
+        self.__checkpoint_size = len(self.__data)
+        self.__journal_size = 0
+        text, self.__journal_offset = self.__read_file(self.journal_path)
+        self.__apply_journal(self.__parse(text))
+
+    def refresh(self) -> list[tuple[int | str, int | str | None, int | str | None]] | None:
+        '''Apply changes written to the files by other processes.\n
+        Only the new entries of the journal are read unless the index was
+        checkpointed, then it's loaded again.\n
+        Returns: changed keys with their old and new values (None for removed
+        keys) or None if the index was loaded again.'''
+        if self.__file_id(self.file_path) != self.__checkpoint_id:
+            self.load()
+            return None
+        text, self.__journal_offset = self.__read_file(self.journal_path, self.__journal_offset)
+        return self.__apply_journal(self.__parse(text))
+
+    def __append_to_journal(self, entries: Iterable[tuple[int | str, int | str]]) -> None:
+        '''Append entries to the journal and checkpoint the index if the journal is too big.'''
+        start = time.perf_counter() if self.metrics else 0.0
+        records = [db.make_record(self.__record_len, key, value) for key, value in entries]
+        if self.__journal is None:
+            self.__journal = open(self.journal_path, "a")
+        self.__journal.writelines(records)
+        self.__journal.flush()
+        self.__journal_offset = self.__journal.tell()
+        if self.metrics:
+            self.__count_flush(start)
+        self.__journal_size += len(records)
+        if self.__journal_size >= max(self.__checkpoint_size, self.min_journal_size):
+            self.checkpoint()
+
+    def set(self, key: int | str, value: int | str) -> None:
+        '''Set a value of a key and write the change to the journal.'''
+        self.__data[key] = value
+        self.__append_to_journal([(key, value)])
+
+    def set_many(self, items: list[tuple[int | str, int | str]]) -> None:
+        '''Set values of many keys and write the changes to the journal at once.'''
+        self.__data.update(items)
+        self.__append_to_journal(items)
+
+    def remove(self, key: int | str) -> int | str:
+        '''Remove a key and write the removal to the journal.'''
+        value = self.__data.pop(key)
+        self.__append_to_journal([(key, '')])
+        return value
+
+    def rebuild(self, items: Iterable[tuple[int | str, int | str]]) -> None:
+        '''Replace all entries of the index and checkpoint it.'''
+        self.__data.clear()
+        self.__data.update(items)
+        self.checkpoint()
+
+    def sync(self) -> None:
+        '''Force the journal to disk.'''
+        if self.__journal is not None:
+            os.fsync(self.__journal.fileno())
+
+    def close(self) -> None:
+        '''Close the handle of the journal file.'''
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+
+    def checkpoint(self) -> None:
+        '''Rewrite the sorted index file with all entries and empty the journal.'''
+        start = time.perf_counter() if self.metrics else 0.0
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, "w") as f:
+            f.writelines(db.make_record(self.__record_len, key, value) for key, value in self.__data.items())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        if self.__journal is None:
+            self.__journal = open(self.journal_path, "a")
+        self.__journal.truncate(0)
+        self.__checkpoint_id = self.__file_id(self.file_path)
+        self.__checkpoint_size = len(self.__data)
+        self.__journal_size = 0
+        self.__journal_offset = 0
+        if self.metrics:
+            self.__count_flush(start)
+
+    def __count_flush(self, start: float) -> None:
+        '''Count a write of the index files that started at a time.'''
+        self.metrics.count('index_flushes')
+        self.metrics.count('index_flush_seconds', time.perf_counter() - start)
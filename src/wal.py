@@ -0,0 +1,202 @@
+import json
+import os
+import threading
+import time
+from typing import Any, BinaryIO, Callable
+
+
+class WriteAheadLog:
+    '''A log of operations that are written before they are applied to the tables.\n
+    Every operation is a JSON line with its id, its name and its arguments,
+    followed by a marker line with the id when the operation is applied.
+    Processes using the database append to the same log holding the lock of
+    the database, so an operation without a marker that another process
+    wrote was left by a crash of that process: `catch_up` reads the lines
+    appended by other processes and finds such operations. The log is emptied
+    by `truncate` only when every operation in it is marked.\n
+    Lines are flushed to the OS right away, and fsync is called once for a
+    group of operations: when `group_commit_size` operations are waiting or
+    when the oldest of them has waited for `group_commit_delay` seconds. The
+    delay is kept by a background thread that calls `flush` (`sync` by default).
+    `before_sync` is called before every fsync to force the changes of the
+    operations to disk, so that the markers of applied operations never reach
+    the disk before the changes.\n
+    With `group_commit_size` 1 every operation is forced to disk before its
+    changes are made, and the log repairs the tables after a power loss.
+    With bigger groups the changes of the operations of the last group can
+    reach the disk before the log does, so only crashes of the process are
+    recovered from for sure.'''
+
+    def __init__(self, file_path: str, group_commit_size: int = 100, group_commit_delay: float = 0.01,
+                 before_sync: Callable[[], None] | None = None, flush: Callable[[], None] | None = None) -> None:
+        '''Make a log, the file is read by the first `catch_up` holding the lock of the database.'''
+        self.file_path = file_path
+        self.group_commit_size = group_commit_size
+        self.group_commit_delay = group_commit_delay
+        self.before_sync = before_sync
+        open(file_path, "a").close()
+        self.__file: BinaryIO | None = None
+        # bytes of the file read so far, number of operations in it and the last id
+        self.__offset = 0
+        self.__size = 0
+        self.__last_id = 0
+        # id -> operation and arguments of the operations without markers
+        self.__unapplied: dict[int, tuple[str, Any]] = {}
+        # ids of the operations appended by this log that aren't marked yet
+        self.__own: set[int] = set()
+        # number of operations waiting for fsync
+        self.__pending = 0
+        self.__pending_since = 0.0
+        # background thread forcing a group to disk after the delay, it's started on first use
+        self.flush = flush or self.sync
+        self.__flusher: threading.Thread | None = None
+        self.__wakeup = threading.Condition()
+        self.__stopped = False
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __handle(self) -> BinaryIO:
+        '''Get a long-lived handle of the log file, opening it on first use.'''
+        if self.__file is None:
+            self.__file = open(self.file_path, "ab")
+        return self.__file
+
+    def catch_up(self) -> list[tuple[int, str, Any]]:
+        '''Read the lines appended by other processes, it must be called holding the lock.\n
+        The log is read again from the start if it was replaced by `truncate`
+        in another process, an incomplete line left by a crash is cut off.\n
+        Returns: ids, operations and arguments of the operations without markers
+        that weren't appended by this log.'''
+        f = self.__handle()
+        if os.stat(self.file_path).st_ino != os.fstat(f.fileno()).st_ino:
+            f.close()
+            self.__file = None
+            f = self.__handle()
+            self.__offset = self.__size = self.__last_id = 0
+            self.__unapplied.clear()
+            self.__own.clear()
+        if os.fstat(f.fileno()).st_size != self.__offset:
+            with open(self.file_path, "rb") as log:
+                log.seek(self.__offset)
+                data = log.read()
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b'\n'):
+                    break
+                self.__read_entry(json.loads(line))
+                self.__offset += len(line)
+            f.truncate(self.__offset)
+        return [(entry_id, op, args) for entry_id, (op, args) in self.__unapplied.items()
+                if entry_id not in self.__own]
+
+    def __read_entry(self, entry: dict[str, Any]) -> None:
+        if 'op' in entry:
+            # operations logged before the ids were added get the next ids
+            entry_id = entry.get('id', self.__last_id + 1)
+            self.__last_id = max(self.__last_id, entry_id)
+            self.__unapplied[entry_id] = (entry['op'], entry['args'])
+            self.__size += 1
+        elif entry['applied'] is True:
+            # a marker without an id is of the oldest operation
+            if self.__unapplied:
+                self.__unapplied.pop(next(iter(self.__unapplied)))
+        else:
+            self.__unapplied.pop(entry['applied'], None)
+
+    def __write(self, entry: dict[str, Any]) -> None:
+        line = json.dumps(entry).encode() + b'\n'
+        f = self.__handle()
+        f.write(line)
+        f.flush()
+        self.__offset += len(line)
+
+    def append(self, op: str, args: Any) -> int:
+        '''Write an operation to the log holding the lock.\n
+        Returns: the id of the operation.'''
+        self.catch_up()
+        self.__last_id += 1
+        entry_id = self.__last_id
+        self.__write({'id': entry_id, 'op': op, 'args': args})
+        self.__unapplied[entry_id] = (op, args)
+        self.__own.add(entry_id)
+        self.__size += 1
+        if not self.__pending:
+            self.__pending_since = time.monotonic()
+        self.__pending += 1
+        if (self.__pending >= self.group_commit_size
+                or time.monotonic() - self.__pending_since >= self.group_commit_delay):
+            self.sync()
+        elif self.__pending == 1:
+            self.__wake_flusher()
+        return entry_id
+
+    def __wake_flusher(self) -> None:
+        '''Tell the background thread that a new group is waiting.'''
+        with self.__wakeup:
+            if self.__stopped:
+                return
+            if self.__flusher is None:
+                self.__flusher = threading.Thread(target=self.__run_flusher, name='wal-flusher', daemon=True)
+                self.__flusher.start()
+            self.__wakeup.notify()
+
+    def __run_flusher(self) -> None:
+        '''Call `flush` when the oldest waiting operation has waited for `group_commit_delay` seconds.'''
+        while True:
+            with self.__wakeup:
+                while not self.__stopped and not self.__pending:
+                    self.__wakeup.wait()
+                if self.__stopped:
+                    return
+                delay = self.__pending_since + self.group_commit_delay - time.monotonic()
+                if delay > 0:
+                    self.__wakeup.wait(delay)
+                    continue
+            # `flush` may wait for a lock held by a writer that wakes the thread up
+            self.flush()
+
+    def stop(self) -> None:
+        '''Stop the background thread, the waiting operations are forced to disk by `sync` or `close`.'''
+        with self.__wakeup:
+            self.__stopped = True
+            self.__wakeup.notify()
+        if self.__flusher is not None and self.__flusher is not threading.current_thread():
+            self.__flusher.join()
+
+    def mark_applied(self, entry_id: int) -> None:
+        '''Mark an operation as applied.'''
+        self.__write({'applied': entry_id})
+        self.__unapplied.pop(entry_id, None)
+        self.__own.discard(entry_id)
+
+    def sync(self) -> None:
+        '''Force the waiting operations to disk.'''
+        if self.__pending:
+            if self.before_sync:
+                self.before_sync()
+            os.fsync(self.__handle().fileno())
+            self.__pending = 0
+
+    def truncate(self) -> bool:
+        '''Remove all operations of the log if they're all marked as applied.\n
+        The file is replaced by an empty one, so that other processes notice it.\n
+        Returns: False if the log has operations without markers and is kept.'''
+        self.catch_up()
+        if self.__unapplied:
+            return False
+        with open(self.file_path + ".tmp", "wb") as f:
+            os.fsync(f.fileno())
+        os.replace(self.file_path + ".tmp", self.file_path)
+        self.__file.close()
+        self.__file = None
+        self.__offset = self.__size = self.__last_id = 0
+        self.__pending = 0
+        return True
+
+    def close(self) -> None:
+        '''Stop the background thread, force the waiting operations to disk and close the log.'''
+        self.stop()
+        self.sync()
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
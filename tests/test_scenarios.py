@@ -1,10 +1,26 @@
-from datetime import datetime
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 from decimal import Decimal
 
 import pytest
 
+from async_service import AsyncCarService
 from bibip_car_service import CarService
+from btree_index import BTreeIndex
+from compact_index import CompactMap
+from migrate import migrate
 from models import Car, CarFullInfo, CarStatus, Model, ModelSaleStats, Sale
+from replica import ReadReplicaCarService
+from sharding import ShardedCarService, shard_of
+from wal import WriteAheadLog
+
+
+def is_cheap(price: Decimal) -> bool:
+    return price < Decimal("3000")
 
 
 @pytest.fixture
@@ -290,3 +306,890 @@ class TestCarServiceScenarios:
             ModelSaleStats(car_model_name="Pathfinder", brand="Nissan", sales_number=1),
         ]
         assert service.top_models_by_sales() == top_3_models
+
+    def test_reopen_database(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        service.sell_car(sale)
+        full_info = service.get_car_info("KNAGM4A77D5316538")
+
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info("KNAGM4A77D5316538") == full_info
+
+        # a missing index is rebuilt from the table
+        os.remove(os.path.join(tmpdir, "cars_index_journal.txt"))
+        rebuilt = CarService(tmpdir)
+        assert rebuilt.get_car_info("KNAGM4A77D5316538") == full_info
+        assert os.path.exists(os.path.join(tmpdir, "cars_index.txt"))
+
+    def test_index_journal(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        # inserts are appended to the journal instead of rewriting the index file
+        journal_path = os.path.join(tmpdir, "cars_index_journal.txt")
+        assert os.path.getsize(journal_path) == len(car_data) * 31
+        assert not os.path.exists(os.path.join(tmpdir, "cars_index.txt"))
+
+        service.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        full_info = service.get_car_info("UPDGM4A77D5316538")
+        assert CarService(tmpdir).get_car_info("UPDGM4A77D5316538") == full_info
+
+        service.checkpoint()
+        assert os.path.getsize(journal_path) == 0
+        assert os.path.getsize(os.path.join(tmpdir, "cars_index.txt")) == len(car_data) * 31
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info("UPDGM4A77D5316538") == full_info
+        assert reopened.get_car_info("KNAGM4A77D5316538") is None
+
+    def test_bulk_load(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        models_path = os.path.join(tmpdir, "feed_models.csv")
+        with open(models_path, "w") as f:
+            f.write("id,name,brand\n")
+            f.writelines(f"{model.id},{model.name},{model.brand}\n" for model in model_data)
+        cars_path = os.path.join(tmpdir, "feed_cars.jsonl")
+        with open(cars_path, "w") as f:
+            f.writelines(car.model_dump_json() + "\n" for car in car_data)
+
+        assert service.load_file(models_path, "models") == len(model_data)
+        assert service.load_file(cars_path, "cars") == len(car_data)
+        assert service.sell_cars(
+            Sale(
+                sales_number=f"20240903#{vin}",
+                car_vin=vin,
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2999.99"),
+            )
+            for vin in ("KNAGM4A77D5316538", "KNAGH4A48A5414970")
+        ) == 2
+
+        available_cars = [car for car in car_data if car.status == CarStatus.available][2:]
+        assert service.get_cars(CarStatus.available) == available_cars
+        reopened = CarService(tmpdir)
+        car = reopened.get_car_info("KNAGH4A48A5414970")
+        assert car is not None
+        assert car.status == CarStatus.sold
+        assert car.sales_cost == Decimal("2999.99")
+        assert reopened.top_models_by_sales()[0] == ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=2)
+
+    def test_close_service(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        with CarService(tmpdir) as service:
+            self._fill_initial_data(service, car_data, model_data)
+            full_info = service.get_car_info("KNAGM4A77D5316538")
+            assert full_info is not None
+
+        with CarService(tmpdir) as reopened:
+            assert reopened.get_car_info("KNAGM4A77D5316538") == full_info
+
+    def test_status_index(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+        # the status text inside another field must not match
+        tricky_car = Car(
+            vin="SOLDAVAILABLE0001",
+            model=1,
+            price=Decimal("1000"),
+            date_start=datetime(2024, 9, 1),
+            status=CarStatus.delivery,
+        )
+        service.add_car(tricky_car)
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        service.sell_car(sale)
+
+        sold_car = car_data[0].model_copy(update={"status": CarStatus.sold})
+        available_cars = [car for car in car_data[1:] if car.status == CarStatus.available]
+        assert service.get_cars(CarStatus.sold) == [sold_car]
+        assert service.get_cars(CarStatus.available) == available_cars
+        assert service.get_cars(CarStatus.delivery) == [car_data[-1], tricky_car]
+
+        service.revert_sale(sale.sales_number)
+        reopened = CarService(tmpdir)
+        assert reopened.get_cars(CarStatus.sold) == []
+        assert reopened.get_cars(CarStatus.available) == [car_data[0]] + available_cars
+
+    def test_revert_sale_reuses_slot(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+        sales = [
+            Sale(
+                sales_number=f"20240903#{vin}",
+                car_vin=vin,
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2999.99"),
+            )
+            for vin in ("KNAGM4A77D5316538", "KNAGH4A48A5414970", "JM1BL1TFXD1734246")
+        ]
+        service.sell_car(sales[0])
+        service.sell_car(sales[1])
+        sales_path = os.path.join(tmpdir, "sales.txt")
+        table_size = os.path.getsize(sales_path)
+
+        # the removed sale leaves a tombstone that is reused by the next sale
+        service.revert_sale(sales[0].sales_number)
+        assert os.path.getsize(sales_path) == table_size
+        assert CarService(tmpdir).get_car_info("KNAGH4A48A5414970").sales_cost == Decimal("2999.99")
+        service.sell_car(sales[2])
+        assert os.path.getsize(sales_path) == table_size
+
+        service.revert_sale(sales[1].sales_number)
+        service.compact_sales()
+        assert os.path.getsize(sales_path) == table_size // 2
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info("JM1BL1TFXD1734246").status == CarStatus.sold
+        assert reopened.get_car_info("KNAGH4A48A5414970").status == CarStatus.available
+        assert reopened.top_models_by_sales() == [ModelSaleStats(car_model_name="3", brand="Mazda", sales_number=1)]
+
+    def test_top_models_counters(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+        service.sell_cars(
+            Sale(
+                sales_number=f"20240903#{vin}",
+                car_vin=vin,
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2999.99"),
+            )
+            for vin in ("KNAGM4A77D5316538", "JM1BL1TFXD1734246", "JM1BL1M58C1614725", "5N1CR2MN9EC641864")
+        )
+        service.update_vin("JM1BL1TFXD1734246", "UPDBL1TFXD1734246")
+        service.revert_sale("20240903#5N1CR2MN9EC641864")
+
+        top_models = [
+            ModelSaleStats(car_model_name="3", brand="Mazda", sales_number=2),
+            ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=1),
+        ]
+        assert service.top_models_by_sales(k=5) == top_models
+        assert service.top_models_by_sales(k=1) == top_models[:1]
+        assert service.get_car_info("UPDBL1TFXD1734246").sales_cost == Decimal("2999.99")
+
+        # missing counters are rebuilt from the tables
+        service.checkpoint()
+        os.remove(os.path.join(tmpdir, "models_sales_index.txt"))
+        reopened = CarService(tmpdir)
+        assert reopened.top_models_by_sales(k=5) == top_models
+        reopened.revert_sale("20240903#UPDBL1TFXD1734246")
+        assert reopened.top_models_by_sales(k=5)[0].sales_number == 1
+
+    def test_top_models_ties(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+        # models with the same amount of sales are ordered by their first sales
+        for i, vin in enumerate(["KNAGM4A77D5316538", "JM1BL1TFXD1734246", "JM1BL1M58C1614725", "KNAGH4A48A5414970"]):
+            service.sell_car(
+                Sale(
+                    sales_number=f"2024090{i + 1}#{vin}",
+                    car_vin=vin,
+                    sales_date=datetime(2024, 9, i + 1),
+                    cost=Decimal("2999.99"),
+                )
+            )
+        top_models = [
+            ModelSaleStats(car_model_name="Optima", brand="Kia", sales_number=2),
+            ModelSaleStats(car_model_name="3", brand="Mazda", sales_number=2),
+        ]
+        assert service.top_models_by_sales(k=2) == top_models
+
+        # the order is kept by the counters rebuilt from the tables
+        service.checkpoint()
+        os.remove(os.path.join(tmpdir, "models_sales_index.txt"))
+        reopened = CarService(tmpdir)
+        assert reopened.top_models_by_sales(k=2) == top_models
+
+    def test_query(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        query = service.query(
+            "cars",
+            where={"model": 3, "price": lambda price: price < Decimal("2600"), "date_start": datetime(2024, 5, 17)},
+        )
+        assert list(query) == [car_data[3], car_data[4]]
+        assert list(service.query("cars", where={"status": CarStatus.reserve}, fields=["vin", "model"])) == [
+            {"vin": "5XYPH4A10GG021831", "model": 2},
+            {"vin": "JM1BL1M58C1614725", "model": 3},
+        ]
+        assert list(service.query("models", where={"id": 4})) == [model_data[3]]
+        assert list(service.query("models", where={"brand": "Kia"}, fields=["name"])) == [
+            {"name": "Optima"},
+            {"name": "Sorento"},
+        ]
+        assert list(service.query("sales", where={"car_vin": "KNAGM4A77D5316538"})) == []
+        with pytest.raises(ValueError):
+            list(service.query("cars", where={"color": "red"}))
+
+    def test_get_cars_pages(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+
+        available_cars = [car for car in car_data if car.status == CarStatus.available]
+        pages = []
+        page = service.get_cars(CarStatus.available, limit=3)
+        while page:
+            pages.append(page)
+            page = service.get_cars(CarStatus.available, limit=3, after=page[-1].vin)
+        assert [len(page) for page in pages] == [3, 3, 2]
+        assert [car for page in pages for car in page] == available_cars
+
+        cars = service.iter_cars(CarStatus.available)
+        assert next(cars) == available_cars[0]
+        # the iterator keeps working while statuses change
+        service.sell_car(
+            Sale(
+                sales_number="20240903#KNAGH4A48A5414970",
+                car_vin="KNAGH4A48A5414970",
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2999.99"),
+            )
+        )
+        assert list(cars) == available_cars[2:]
+
+    def test_binary_storage(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        text_path = os.path.join(tmpdir, "text")
+        os.makedirs(text_path)
+        service = CarService(text_path, record_len=120)
+        self._fill_initial_data(service, car_data, model_data)
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        service.sell_car(sale)
+        full_info = service.get_car_info("KNAGM4A77D5316538")
+        assert os.path.getsize(os.path.join(text_path, "cars.txt")) == len(car_data) * (120 + len(os.linesep))
+        with pytest.raises(ValueError):
+            CarService(text_path, storage_format="binary")
+
+        binary_path = os.path.join(tmpdir, "binary")
+        migrate(text_path, binary_path, "binary")
+        migrated = CarService(binary_path)
+        assert migrated.storage_format == "binary"
+        assert os.path.getsize(os.path.join(binary_path, "cars.txt")) < len(car_data) * 50
+        assert migrated.get_car_info("KNAGM4A77D5316538") == full_info
+        assert migrated.get_cars(CarStatus.available) == service.get_cars(CarStatus.available)
+        assert list(migrated.query("cars", where={"price": Decimal("2276.65")})) == [car_data[3]]
+        assert migrated.top_models_by_sales() == service.top_models_by_sales()
+
+        migrated.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        migrated.revert_sale("20240903#UPDGM4A77D5316538")
+        reopened = CarService(binary_path)
+        assert reopened.get_car_info("UPDGM4A77D5316538").status == CarStatus.available
+
+    def test_trusted_decode(self, car_data: list[Car], model_data: list[Model]):
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3, 12, 30),
+            cost=Decimal("2999.99"),
+        )
+        for obj in [*car_data, *model_data, sale]:
+            record = obj.make_record(500)
+            trusted = type(obj).make_trusted_object(record)
+            assert trusted == type(obj).make_object(record) == obj
+            assert trusted.model_dump() == obj.model_dump()
+
+    def test_wal_replay(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+
+        self._fill_initial_data(service, car_data, model_data)
+        service.close()
+        assert os.path.getsize(os.path.join(tmpdir, "wal.txt")) == 0
+
+        # a crash after a sale was logged and half of its record was written
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        with open(os.path.join(tmpdir, "wal.txt"), "a") as f:
+            f.write('{"op": "sell_car", "args": ' + sale.model_dump_json() + '}\n{"op": "upd')
+        with open(os.path.join(tmpdir, "sales.txt"), "ab") as f:
+            f.write(b"20240903#KNAGM4A77D5316538;")
+
+        service = CarService(tmpdir)
+        full_info = service.get_car_info("KNAGM4A77D5316538")
+        assert full_info.status == CarStatus.sold
+        assert full_info.sales_cost == Decimal("2999.99")
+        assert os.path.getsize(os.path.join(tmpdir, "wal.txt")) == 0
+
+        # applied operations aren't replayed again
+        service.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info("KNAGM4A77D5316538") is None
+        assert reopened.get_car_info("UPDGM4A77D5316538").sales_cost == Decimal("2999.99")
+        assert reopened.top_models_by_sales(1)[0].sales_number == 1
+
+    def test_wal_group_commit(self, tmpdir: str):
+        syncs: list[str] = []
+        wal = WriteAheadLog(os.path.join(tmpdir, "wal.txt"), group_commit_size=1,
+                            before_sync=lambda: syncs.append("tables"))
+        # an operation is forced to disk before it's applied
+        wal.mark_applied(wal.append("add_model", {"id": 1}))
+        assert syncs == ["tables"]
+        wal.close()
+
+        # the last group is forced to disk after the delay without new operations
+        wal = WriteAheadLog(os.path.join(tmpdir, "wal.txt"), group_commit_size=100, group_commit_delay=0.01,
+                            before_sync=lambda: syncs.append("tables"))
+        wal.append("add_model", {"id": 2})
+        assert syncs == ["tables"]
+        deadline = time.monotonic() + 5
+        while len(syncs) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert syncs == ["tables", "tables"]
+        wal.close()
+
+    def test_wal_shared_by_processes(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        path = os.path.join(tmpdir, "wal.txt")
+        first, second = WriteAheadLog(path), WriteAheadLog(path)
+        # a marker is matched to its operation by id, not to the oldest one
+        first_id = first.append("add_model", {"id": 1})
+        second.mark_applied(second.append("add_model", {"id": 2}))
+        assert WriteAheadLog(path).catch_up() == [(first_id, "add_model", {"id": 1})]
+        # the log isn't emptied while another log has an operation without a marker
+        assert not second.truncate()
+        first.mark_applied(first_id)
+        assert second.truncate()
+        assert os.path.getsize(path) == 0
+        assert first.catch_up() == []
+        first.close()
+        second.close()
+
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        other = CarService(tmpdir)
+        # another process crashed after it logged a sale and wrote half of its record
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        with open(path, "a") as f:
+            f.write('{"id": 1000, "op": "sell_car", "args": ' + sale.model_dump_json() + '}\n')
+        with open(os.path.join(tmpdir, "sales.txt"), "ab") as f:
+            f.write(b"20240903#KNAGM4A77D5316538;")
+
+        # the next writer replays the operation before its own one
+        service.sell_car(Sale(
+            sales_number="20240903#JM1BL1M58C1614725",
+            car_vin="JM1BL1M58C1614725",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("1999.99"),
+        ))
+        assert other.get_car_info("KNAGM4A77D5316538").status == CarStatus.sold
+        assert other.get_car_info("KNAGM4A77D5316538").sales_cost == Decimal("2999.99")
+        assert other.get_car_info("JM1BL1M58C1614725").status == CarStatus.sold
+        assert sorted(stats.sales_number for stats in other.top_models_by_sales(2)) == [1, 1]
+        service.checkpoint()
+        assert os.path.getsize(path) == 0
+        other.close()
+        service.close()
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info("KNAGM4A77D5316538").status == CarStatus.sold
+        assert len(reopened.get_sales(datetime(2024, 9, 1), datetime(2024, 9, 30))) == 2
+        reopened.close()
+
+    def test_concurrent_services(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        other = CarService(tmpdir)
+
+        # changes of one service are seen by another one using the same directory
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        service.sell_car(sale)
+        assert other.get_car_info("KNAGM4A77D5316538").sales_cost == Decimal("2999.99")
+        assert "KNAGM4A77D5316538" not in [car.vin for car in other.get_cars(CarStatus.available)]
+        other.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        assert service.get_car_info("KNAGM4A77D5316538") is None
+        assert service.get_car_info("UPDGM4A77D5316538").status == CarStatus.sold
+        service.checkpoint()
+        other.revert_sale("20240903#UPDGM4A77D5316538")
+        assert service.get_car_info("UPDGM4A77D5316538").status == CarStatus.available
+
+        # readers and writers in many threads
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            sold = executor.map(service.sell_car, [
+                Sale(sales_number=f"20240903#{car.vin}", car_vin=car.vin,
+                     sales_date=datetime(2024, 9, 3), cost=Decimal("100"))
+                for car in car_data[1:]
+            ])
+            infos = [executor.submit(other.get_car_info, car.vin) for car in car_data[1:] * 10]
+            assert all(car is not None for car in sold)
+            assert all(info.result() is not None for info in infos)
+        assert [car.vin for car in other.get_cars(CarStatus.available)] == ["UPDGM4A77D5316538"]
+        service.close()
+        other.close()
+
+        # readers opening the tables at once share one handle of a table
+        service = CarService(tmpdir, cache_size=0, metrics=True)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert all(executor.map(service.get_car_info, [car.vin for car in car_data[1:]] * 10))
+        assert service.stats()["file_opens"] == 3
+        service.close()
+
+    def test_async_service(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        async def scenario() -> None:
+            async with AsyncCarService(CarService(tmpdir), max_workers=2) as service:
+                await service.add_models(model_data)
+                await service.add_cars(car_data)
+                await service.sell_car(
+                    Sale(
+                        sales_number="20240903#KNAGM4A77D5316538",
+                        car_vin="KNAGM4A77D5316538",
+                        sales_date=datetime(2024, 9, 3),
+                        cost=Decimal("2999.99"),
+                    )
+                )
+
+                # calls made at once are looked up as one batch
+                vins = [car.vin for car in car_data] * 2 + ["UNKNOWN"]
+                infos = await asyncio.gather(*(service.get_car_info(vin) for vin in vins))
+                assert [info.vin for info in infos[:-1]] == vins[:-1]
+                assert infos[-1] is None
+                assert infos[0].sales_cost == Decimal("2999.99")
+
+                available = await service.get_cars(CarStatus.available)
+                assert "KNAGM4A77D5316538" not in [car.vin for car in available]
+                assert (await service.top_models_by_sales())[0].sales_number == 1
+
+        asyncio.run(scenario())
+
+    def test_object_cache(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+
+        full_info = service.get_car_info("KNAGM4A77D5316538")
+        misses = service.cache_stats()["misses"]
+        assert service.get_car_info("KNAGM4A77D5316538") == full_info
+        assert service.cache_stats()["misses"] == misses
+        assert service.cache_stats()["hits"] >= 2
+
+        # cached objects are updated by writes
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        service.sell_car(sale)
+        assert service.get_car_info("KNAGM4A77D5316538").sales_cost == Decimal("2999.99")
+        car = service.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        car.price = Decimal("1")  # changing a returned object doesn't change the cache
+        assert service.get_car_info("KNAGM4A77D5316538") is None
+        assert service.get_car_info("UPDGM4A77D5316538").price == Decimal("2000")
+        service.revert_sale("20240903#UPDGM4A77D5316538")
+        full_info = service.get_car_info("UPDGM4A77D5316538")
+        assert full_info.status == CarStatus.available and full_info.sales_cost is None
+
+        # the cache stays within its memory budget
+        small = CarService(tmpdir, cache_size=2000)
+        for car in car_data:
+            small.get_car_info(car.vin)
+        stats = small.cache_stats()
+        assert 0 < stats["entries"] < 2 * len(car_data)
+        assert stats["bytes"] <= 2000
+        assert CarService(tmpdir, cache_size=0).get_car_info("UPDGM4A77D5316538") == full_info
+
+    def test_metrics(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir, metrics=True)
+        self._fill_initial_data(service, car_data, model_data)
+        for car in car_data:
+            service.get_car_info(car.vin)
+        service.checkpoint()
+
+        stats = service.stats()
+        assert stats["methods"]["add_car"]["calls"] == len(car_data)
+        assert stats["methods"]["get_car_info"]["calls"] == len(car_data)
+        assert sum(stats["methods"]["get_car_info"]["buckets"].values()) == len(car_data)
+        assert stats["bytes_written"] == (len(car_data) + len(model_data)) * (500 + len(os.linesep))
+        assert stats["bytes_read"] > 0 and stats["seeks"] > 0 and stats["file_opens"] > 0
+        assert stats["index_flushes"] >= len(car_data) + len(model_data)
+        assert stats["cache"]["hits"] > 0
+
+        text = service.prometheus_metrics()
+        assert f'bibip_method_duration_seconds_bucket{{method="get_car_info",le="+Inf"}} {len(car_data)}' in text
+        assert f'bibip_method_duration_seconds_count{{method="add_car"}} {len(car_data)}' in text
+        assert f'bibip_bytes_written_total {stats["bytes_written"]}' in text
+
+        # metrics are off by default
+        assert CarService(tmpdir).prometheus_metrics() == ""
+        assert list(CarService(tmpdir).stats()) == ["cache"]
+
+    def test_sales_by_date(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        sales = [
+            Sale(
+                sales_number=f"202409{day:02d}#{car.vin}",
+                car_vin=car.vin,
+                sales_date=datetime(2024, 9, day),
+                cost=Decimal(1000 + day),
+            )
+            for day, car in zip([5, 1, 3, 2, 4], car_data)
+        ]
+        service.sell_car(sales[0])
+        service.sell_cars(sales[1:])
+
+        found = service.get_sales(datetime(2024, 9, 2), datetime(2024, 9, 5))
+        assert [sale.sales_date.day for sale in found] == [2, 3, 4]
+        assert service.revenue(datetime(2024, 9, 2), datetime(2024, 9, 5)) == Decimal(3009)
+        assert service.revenue(datetime(2024, 10, 1), datetime(2024, 11, 1)) == 0
+
+        # the index follows reverted sales and compaction and is persisted
+        service.revert_sale(sales[2].sales_number)
+        assert service.revenue(datetime(2024, 9, 1), datetime(2024, 10, 1)) == Decimal(4012)
+        service.compact_sales()
+        assert [sale.sales_date.day for sale in service.get_sales(datetime(2024, 9, 1), datetime(2024, 10, 1))] \
+            == [1, 2, 4, 5]
+        service.close()
+        assert CarService(tmpdir).revenue(datetime(2024, 9, 4), datetime(2024, 9, 6)) == Decimal(2009)
+        os.remove(os.path.join(tmpdir, "sales_date_index_journal.txt"))
+        assert CarService(tmpdir).revenue(datetime(2024, 9, 4), datetime(2024, 9, 6)) == Decimal(2009)
+
+    def test_get_car_info_many(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir, cache_size=0)
+        self._fill_initial_data(service, car_data, model_data)
+        service.sell_car(
+            Sale(
+                sales_number="20240903#JM1BL1TFXD1734246",
+                car_vin="JM1BL1TFXD1734246",
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2999.99"),
+            )
+        )
+        vins = ["UNKNOWN", *reversed([car.vin for car in car_data]), car_data[0].vin]
+        assert service.get_car_info_many(vins) == [service.get_car_info(vin) for vin in vins]
+        assert service.get_car_info_many([]) == []
+
+    def test_parallel_query(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir, scan_workers=3)
+        service.parallel_scan_size = 1
+        self._fill_initial_data(service, car_data, model_data)
+
+        cheap = [car for car in car_data if car.price < Decimal("3000")]
+        # a module-level predicate is checked by the workers, a lambda in this process
+        assert list(service.query("cars", where={"price": is_cheap})) == cheap
+        assert list(service.query("cars", where={"price": lambda price: price < Decimal("3000")})) == cheap
+        assert list(service.query("cars", where={"model": 3}, fields=["vin"])) == [
+            {"vin": car.vin} for car in car_data if car.model == 3
+        ]
+        assert list(service.query("models")) == model_data
+        assert list(service.query("sales")) == []
+
+        # the lock isn't held between the results, so the table can be written during a scan
+        cars = service.query("cars", where={"price": is_cheap})
+        assert next(cars) == cheap[0]
+        service.update_vin(cheap[1].vin, "UPDATED0000000001")
+        assert len(list(cars)) == len(cheap) - 1
+        assert service.get_car_info("UPDATED0000000001") is not None
+        service.close()
+
+        # binary records are sent to the workers too
+        os.makedirs(os.path.join(tmpdir, "binary"))
+        service = CarService(os.path.join(tmpdir, "binary"), storage_format="binary", scan_workers=2)
+        service.parallel_scan_size = 1
+        self._fill_initial_data(service, car_data, model_data)
+        assert list(service.query("cars", where={"price": is_cheap})) == cheap
+        service.close()
+
+    def test_btree_index(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir, index_backend="btree")
+        self._fill_initial_data(service, car_data, model_data)
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        service.sell_car(sale)
+        service.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        full_info = service.get_car_info("UPDGM4A77D5316538")
+        assert full_info.sales_cost == Decimal("2999.99")
+        assert service.get_car_info("KNAGM4A77D5316538") is None
+        assert not os.path.exists(os.path.join(tmpdir, "cars_index.txt"))
+        service.close()
+
+        # the tree is used without loading and a tree left dirty by a crash is rebuilt
+        assert CarService(tmpdir, index_backend="btree").get_car_info("UPDGM4A77D5316538") == full_info
+        with open(os.path.join(tmpdir, "cars_index.btree"), "r+b") as f:
+            f.seek(BTreeIndex.header.size - 1)
+            f.write(b"\1")
+        assert CarService(tmpdir, index_backend="btree").get_car_info("UPDGM4A77D5316538") == full_info
+        # switching the backend rebuilds the other indexes
+        reopened = CarService(tmpdir)
+        assert reopened.get_car_info("UPDGM4A77D5316538") == full_info
+        assert not os.path.exists(os.path.join(tmpdir, "cars_index.btree"))
+
+        # small pages are split and removed keys are skipped
+        tree = BTreeIndex(os.path.join(tmpdir, "numbers.btree"), int, page_size=64)
+        tree.load()
+        tree.set_many([(i, i * 2) for i in range(1000)])
+        for i in range(0, 1000, 3):
+            assert tree.remove(i) == i * 2
+        assert len(tree) == 666
+        assert list(tree.items()) == [(i, i * 2) for i in range(1000) if i % 3]
+        assert 3 not in tree and tree[500] == 1000
+
+    def test_aggregate(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir)
+        self._fill_initial_data(service, car_data, model_data)
+        vins = ["KNAGM4A77D5316538", "5XYPH4A10GG021831", "JM1BL1TFXD1734246", "5N1CR2MN9EC641864"]
+        service.sell_cars(
+            Sale(
+                sales_number=f"2024090{i}#{vin}",
+                car_vin=vin,
+                sales_date=datetime(2024, 9 + i % 2, 1 + i),
+                cost=Decimal("1000.50") * (i + 1),
+            )
+            for i, vin in enumerate(vins)
+        )
+
+        metrics = {"sales": ("count", None), "revenue": ("sum", "cost")}
+        assert service.aggregate(["brand", "sales_date.month"], metrics) == [
+            {"brand": "Kia", "sales_date.month": date(2024, 9, 1), "sales": 1, "revenue": Decimal("1000.50")},
+            {"brand": "Kia", "sales_date.month": date(2024, 10, 1), "sales": 1, "revenue": Decimal("2001.00")},
+            {"brand": "Mazda", "sales_date.month": date(2024, 9, 1), "sales": 1, "revenue": Decimal("3001.50")},
+            {"brand": "Nissan", "sales_date.month": date(2024, 10, 1), "sales": 1, "revenue": Decimal("4002.00")},
+        ]
+        sales_by_model = service.aggregate(["name"], {"sales": ("count", None)})
+        top_models = service.top_models_by_sales(len(model_data))
+        assert {(stats.car_model_name, stats.sales_number) for stats in top_models} == {
+            (group["name"], group["sales"]) for group in sales_by_model
+        }
+        # decimals are in hundredths in the columns passed to callables
+        markup = service.aggregate([], {"markup": ("sum", lambda columns: columns["cost"] - columns["price"])})
+        assert markup == [{"markup": 32835}]
+
+        # overwritten records are read again
+        service.revert_sale("20240900#KNAGM4A77D5316538")
+        service.update_vin("5XYPH4A10GG021831", "UPDPH4A10GG021831")
+        assert service.aggregate(["status"], {"cars": ("count", None), "max_price": ("max", "price")}, "cars") == [
+            {"status": "available", "cars": 6, "max_price": Decimal("3200")},
+            {"status": "delivery", "cars": 1, "max_price": Decimal("2280.76")},
+            {"status": "reserve", "cars": 1, "max_price": Decimal("2549.10")},
+            {"status": "sold", "cars": 3, "max_price": Decimal("3100")},
+        ]
+        assert service.aggregate(["car_vin"], {"cost": ("min", "cost")})[-1] == {
+            "car_vin": "UPDPH4A10GG021831",
+            "cost": Decimal("2001.00"),
+        }
+        with pytest.raises(ValueError):
+            service.aggregate(["color"], {"sales": ("count", None)})
+
+    def test_compact_index(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        service = CarService(tmpdir, index_backend="compact")
+        self._fill_initial_data(service, car_data, model_data)
+        service.sell_car(
+            Sale(
+                sales_number="20240903#KNAGM4A77D5316538",
+                car_vin="KNAGM4A77D5316538",
+                sales_date=datetime(2024, 9, 3),
+                cost=Decimal("2999.99"),
+            )
+        )
+        service.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        full_info = service.get_car_info("UPDGM4A77D5316538")
+        assert full_info.sales_cost == Decimal("2999.99")
+        assert service.get_car_info("KNAGM4A77D5316538") is None
+        service.checkpoint()
+        service.close()
+        # compact indexes are stored in the files of in-memory ones
+        assert CarService(tmpdir).get_car_info("UPDGM4A77D5316538") == full_info
+        assert CarService(tmpdir, index_backend="compact").get_car_info("UPDGM4A77D5316538") == full_info
+
+        # changes are merged from the delta into the packed keys
+        index = CompactMap(str)
+        index.min_merge_size = 4
+        index.update((f"VIN{i:03}", i) for i in range(0, 100, 2))
+        for i in range(1, 100, 2):
+            index[f"VIN{i:03}"] = i
+        assert index.pop("VIN010") == 10
+        index["A-LONGER-KEY-THAN-THE-OTHERS"] = 1000
+        assert len(index) == 100
+        assert "VIN010" not in index and index["VIN011"] == 11 and index.get("VIN100") is None
+        assert list(index.items()) == [("A-LONGER-KEY-THAN-THE-OTHERS", 1000)] + [
+            (f"VIN{i:03}", i) for i in range(100) if i != 10
+        ]
+
+    def test_sharded_service(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        os.makedirs(os.path.join(tmpdir, "single"))
+        os.makedirs(os.path.join(tmpdir, "sharded"))
+        service = CarService(os.path.join(tmpdir, "single"))
+        sharded = ShardedCarService(os.path.join(tmpdir, "sharded"), shards=3)
+        sales = [
+            Sale(
+                sales_number=f"2024090{i}#{vin}",
+                car_vin=vin,
+                sales_date=datetime(2024, 9, 1 + i),
+                cost=Decimal("3000"),
+            )
+            for i, vin in enumerate(["KNAGM4A77D5316538", "5N1CR2MN9EC641864", "5N1CR2TS0HW037674"])
+        ]
+        for db in (service, sharded):
+            self._fill_initial_data(db, car_data, model_data)
+            db.sell_cars(sales)
+
+        # every car is in the shard of its vin
+        for n, shard in enumerate(sharded.shards):
+            assert [car.vin for car in shard.query("cars")] == [
+                car.vin for car in car_data if shard_of(car.vin, 3) == n
+            ]
+            assert list(shard.query("models")) == model_data
+        for car in car_data:
+            assert sharded.get_car_info(car.vin) == service.get_car_info(car.vin)
+        assert sharded.top_models_by_sales() == service.top_models_by_sales()
+        assert sharded.get_sales(datetime(2024, 1, 1), datetime(2025, 1, 1)) == sales
+        assert sharded.revenue(datetime(2024, 1, 1), datetime(2025, 1, 1)) == Decimal("9000")
+        available = sharded.get_cars(CarStatus.available)
+        assert sorted(available, key=lambda car: car.vin) == sorted(
+            service.get_cars(CarStatus.available), key=lambda car: car.vin)
+        assert sharded.get_cars(CarStatus.available, 2) + sharded.get_cars(
+            CarStatus.available, after=available[1].vin) == available
+
+        # an updated vin stays in the shard of the car and is found in other processes
+        assert shard_of("UPDGM4A77D5316538", 3) != shard_of("KNAGM4A77D5316538", 3)
+        sharded.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        other = ShardedCarService(os.path.join(tmpdir, "sharded"), shards=3)
+        assert other.get_car_info("UPDGM4A77D5316538").sales_cost == Decimal("3000")
+        sharded.revert_sale("20240900#UPDGM4A77D5316538")
+        assert other.get_car_info("UPDGM4A77D5316538").status == CarStatus.available
+        assert sharded.get_car_info_many(["UPDGM4A77D5316538", "KNAGM4A77D5316538"]) == [
+            other.get_car_info("UPDGM4A77D5316538"), None]
+        sharded.close()
+        with pytest.raises(ValueError):
+            ShardedCarService(os.path.join(tmpdir, "sharded"), shards=2)
+
+    def test_sharded_sell_after_update_vin(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        first = ShardedCarService(tmpdir, shards=3)
+        self._fill_initial_data(first, car_data, model_data)
+        second = ShardedCarService(tmpdir, shards=3)
+
+        # the car stays in its shard, the other process routes the sale there
+        first.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        sale = Sale(
+            sales_number="20240903#UPDGM4A77D5316538",
+            car_vin="UPDGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        assert second.sell_car(sale).status == CarStatus.sold
+        assert second.get_car_info("UPDGM4A77D5316538").status == CarStatus.sold
+        assert first.top_models_by_sales(1)[0].sales_number == 1
+        assert first.revenue(datetime(2024, 1, 1), datetime(2025, 1, 1)) == Decimal("2999.99")
+
+        # sales of unknown cars aren't saved
+        orphan = Sale(
+            sales_number="20240904#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 4),
+            cost=Decimal("1000"),
+        )
+        assert second.sell_car(orphan) is None
+        assert second.sell_cars([orphan]) == 0
+        assert first.revenue(datetime(2024, 1, 1), datetime(2025, 1, 1)) == Decimal("2999.99")
+        first.close()
+        second.close()
+
+    def test_sharded_top_models(self, tmpdir: str):
+        os.makedirs(os.path.join(tmpdir, "single"))
+        os.makedirs(os.path.join(tmpdir, "sharded"))
+        service = CarService(os.path.join(tmpdir, "single"))
+        sharded = ShardedCarService(os.path.join(tmpdir, "sharded"), shards=3)
+        # models with the same name and brand are counted apart
+        models = [Model(id=1, name="Optima", brand="Kia"), Model(id=2, name="Optima", brand="Kia"),
+                  Model(id=3, name="Logan", brand="Renault")]
+        model_ids = [2, 1, 1, 2, 1, 3, 3]
+        cars = [Car(vin=f"VIN{i:014}", model=model_id, price=Decimal("1000"), date_start=datetime(2024, 1, 1),
+                    status=CarStatus.available) for i, model_id in enumerate(model_ids)]
+        for db in (service, sharded):
+            db.add_models(models)
+            db.add_cars(cars)
+            for i, car in enumerate(cars):
+                db.sell_car(Sale(sales_number=f"2024090{i + 1}#{car.vin}", car_vin=car.vin,
+                                 sales_date=datetime(2024, 9, i + 1), cost=Decimal("1000")))
+        assert [stats.sales_number for stats in sharded.top_models_by_sales()] == [3, 2, 2]
+        assert sharded.top_models_by_sales() == service.top_models_by_sales()
+        sharded.close()
+
+    def test_read_replica(self, tmpdir: str, car_data: list[Car], model_data: list[Model]):
+        os.makedirs(os.path.join(tmpdir, "primary"))
+        os.makedirs(os.path.join(tmpdir, "replica"))
+        service = CarService(os.path.join(tmpdir, "primary"), cdc=True)
+        self._fill_initial_data(service, car_data, model_data)
+        replica = ReadReplicaCarService(os.path.join(tmpdir, "primary"), os.path.join(tmpdir, "replica"))
+        assert replica.applied_seq == len(model_data) + len(car_data)
+        assert list(replica.query("cars")) == car_data
+
+        # the replica catches up before a read
+        sale = Sale(
+            sales_number="20240903#KNAGM4A77D5316538",
+            car_vin="KNAGM4A77D5316538",
+            sales_date=datetime(2024, 9, 3),
+            cost=Decimal("2999.99"),
+        )
+        service.sell_car(sale)
+        assert replica.get_car_info("KNAGM4A77D5316538") == service.get_car_info("KNAGM4A77D5316538")
+        service.update_vin("KNAGM4A77D5316538", "UPDGM4A77D5316538")
+        assert replica.get_car_info("KNAGM4A77D5316538") is None
+        assert replica.get_sales(datetime(2024, 1, 1), datetime(2025, 1, 1))[0].car_vin == "UPDGM4A77D5316538"
+        service.revert_sale("20240903#UPDGM4A77D5316538")
+        with pytest.raises(KeyError):
+            service.revert_sale("20240903#UPDGM4A77D5316538")
+        assert replica.get_car_info("UPDGM4A77D5316538").status == CarStatus.available
+        assert replica.revenue(datetime(2024, 1, 1), datetime(2025, 1, 1)) == Decimal(0)
+        with open(os.path.join(tmpdir, "primary", "cdc.txt")) as f:
+            assert [json.loads(line)["op"] for line in f][-3:] == ["sell_car", "update_vin", "revert_sale"]
+
+        # a reopened replica goes on from the saved position, a replayed change isn't logged twice
+        replica.close()
+        sale = Sale(
+            sales_number="20240904#5XYPH4A10GG021831",
+            car_vin="5XYPH4A10GG021831",
+            sales_date=datetime(2024, 9, 4),
+            cost=Decimal("3000"),
+        )
+        service.sell_car(sale)
+        service.close()
+        with open(os.path.join(tmpdir, "primary", "wal.txt"), "a") as f:
+            f.write('{"op": "sell_car", "args": ' + sale.model_dump_json() + '}\n')
+        # an incomplete change left by a crash is cut off when the log is opened
+        with open(os.path.join(tmpdir, "primary", "cdc.txt"), "a") as f:
+            f.write('{"seq": 100, "op": "add_')
+        service = CarService(os.path.join(tmpdir, "primary"), cdc=True)
+        replica = ReadReplicaCarService(os.path.join(tmpdir, "primary"), os.path.join(tmpdir, "replica"))
+        assert replica.applied_seq == len(model_data) + len(car_data) + 4
+        assert replica.get_car_info("5XYPH4A10GG021831").status == CarStatus.sold
+        assert replica.top_models_by_sales(1) == service.top_models_by_sales(1)
+        service.add_model(Model(id=6, name="Rio", brand="Kia"))
+        assert next(replica.query("models", {"id": 6})).name == "Rio"
+        assert replica.applied_seq == len(model_data) + len(car_data) + 5
+        replica.close()